@@ -0,0 +1,318 @@
+# <GPLv3_Header>
+## - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# \copyright
+#                    Copyright (c) 2024 Nathan Ulmer.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+# <\GPLv3_Header>
+
+##
+# \file benchmark.py
+#
+# \brief Headless benchmarks for the Book, markup and telemetry code in main.py.
+# - - -
+# \par
+# Generates synthetic book/ trees of several sizes in a temporary directory, times the operations the app runs on
+# them and writes the results to JSON so runs from different commits can be compared. Needs no display.
+# \par
+# python benchmark.py --sizes 10000 100000 1000000 --out bench.json
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+
+import main
+
+
+WORDS = ('the', 'a', 'sally', 'walked', 'dog', 'down', 'street', 'menacingly', 'in', 'way', 'only', 'child', 'with',
+         'large', 'knows', 'how', 'to', 'do', 'her', 'head', 'swivelling', 'back', 'and', 'forth', 'were', 'not',
+         'those', 'from', 'person', 'looking', 'for', 'threats', 'they', 'actions', 'of', 'laser', 'targeting',
+         'system', 'empire', 'fall', 'notes', 'chapter', 'river', 'city', 'night', 'quiet', 'storm', 'letter')
+TAGS = ('bold', 'italic', 'bold_italic')
+OTHER_DOCS = ('world', 'characters', 'universeOutline', 'partOutline', 'chapterOutline')
+
+
+def sentence(rng, words):
+    # words words of prose, now and then with a <tag@ ...> span
+    out = [rng.choice(WORDS) for _ in range(words)]
+    if words > 4 and rng.random() < 0.2:
+        i = rng.randrange(words - 2)
+        out[i] = '<%s@ %s' % (rng.choice(TAGS), out[i])
+        out[i + 1] = out[i + 1] + '>'
+    return ' '.join(out) + '.'
+
+
+def paragraph(rng, words):
+    parts = []
+    while words > 0:
+        n = min(words, rng.randint(6, 18))
+        parts.append(sentence(rng, n))
+        words -= n
+    return ' '.join(parts) + '\n'
+
+
+def generateBook(path, words, seed=0):
+    # A book/ tree of about `words` words. 'book' is a run of ']'-terminated segments under '##' chapter headings,
+    # 'unstructured' holds notes with a [book|...] passage for each segment, the rest is tagged prose.
+    # Each passage holds exactly the text of its segment, the newline after the previous ']' and any heading
+    # included, so edits to either side are mirrored rather than skipped.
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    bookWords = int(words * 0.4)
+    segmentWords = 120
+    segments = []
+    for _ in range(max(1, bookWords // segmentWords)):
+        segments.append(paragraph(rng, segmentWords).rstrip('\n'))
+
+    book = []
+    notes = []
+    for (i, segment) in enumerate(segments):
+        if i % 25 == 0:
+            segment = '## Chapter %d\n' % (i // 25 + 1) + segment
+            notes.append('## Notes for chapter %d\n' % (i // 25 + 1))
+        if i > 0:
+            segment = '\n' + segment
+        book.append(segment + ']')
+        notes.append(paragraph(rng, segmentWords // 3))
+        notes.append('[book|' + segment + ']\n')
+    docs = {'book': ''.join(book) + '\n', 'unstructured': ''.join(notes)}
+
+    otherWords = max(1, (words - 2 * bookWords - len(segments) * (segmentWords // 3)) // len(OTHER_DOCS))
+    for docName in OTHER_DOCS:
+        parts = []
+        remaining = otherWords
+        chapter = 0
+        while remaining > 0:
+            chapter += 1
+            parts.append('## %s %d\n' % (docName, chapter))
+            n = min(remaining, 400)
+            parts.append(paragraph(rng, n))
+            remaining -= n
+        docs[docName] = ''.join(parts)
+
+    for (docName, text) in docs.items():
+        with open(os.path.join(path, docName), 'w') as f:
+            f.write(text)
+    return docs
+
+
+def measure(fn, repeat):
+    # Seconds per call of fn, best and median of repeat runs
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {'best': times[0], 'median': times[len(times) // 2], 'runs': repeat}
+
+
+def benchLoad(bk, repeat):
+    results = {}
+
+    def coldLoad():
+        bk.fileStamps.clear()
+        bk.loadDocTree()
+    results['loadDocTree'] = measure(coldLoad, repeat)
+    # Nothing changed on disk, only stats
+    results['loadDocTree unchanged'] = measure(bk.loadDocTree, repeat)
+    return results
+
+
+def benchTokenize(bk, repeat):
+    # What RichText.insertMarkup does before handing the runs to Tk
+    def tokenizeAll():
+        for docName in bk.docTree:
+            for _ in main.tokenizeMarkup(bk.getDocText(docName), docName == 'book'):
+                pass
+    return {'tokenize all documents': measure(tokenizeAll, repeat)}
+
+
+def benchSearch(bk, repeat):
+    # Building the whole index from scratch, then queries against it: a common word, a rare one and a phrase
+    def build():
+        for docName in bk.docTree:
+            bk.search.setDoc(docName, len(bk.docTree[docName]))
+        bk.search.refresh()
+    results = {'search index build': measure(build, repeat)}
+    for query in ('the', 'laser', 'walked down the street'):
+        results['search %r' % query] = measure(lambda: bk.search.search(query), repeat)
+    return results
+
+
+def benchKeystrokes(bk, keys, seed=0):
+    # Single-character edits the way Application.onTextEdit applies them: Book update, then the mirrored edits the
+    # SyncEngine returns. Positions are random, so they land in notes, passages and book segments alike. The typed
+    # characters are then deleted again in reverse order, which has to restore both documents.
+    rng = random.Random(seed)
+    sync = main.SyncEngine(bk)
+    # Every passage has to match its segment, or the sync would skip it and this would time nothing
+    for n in range(bk.links['unstructured'].closerCount()):
+        (opener, sep, close) = sync.passage('unstructured', n)
+        (start, end, closed) = bk.links['book'].segmentRange(n, bk.docLength('book'))
+        assert bk.slice('unstructured', sep + 1, close) == bk.slice('book', start, end), n
+    mirrored = [0]
+
+    def apply(edits):
+        mirrored[0] += len(edits)
+        for (docName, start, end, text) in edits:
+            if end > start:
+                bk.deleteAt(docName, start, end - start)
+            bk.insertAt(docName, start, text)
+
+    docs = ['book', 'unstructured']
+    plan = []
+    for _ in range(keys):
+        docName = rng.choice(docs)
+        plan.append((docName, rng.randrange(bk.docLength(docName) + 1), rng.choice('etaoin shrdlu\n')))
+
+    before = dict((docName, bk.getDocText(docName)) for docName in docs)
+    typedAt = []
+    # A keystroke the SyncEngine can't mirror reports its link pair once, keep that out of the output
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        start = time.perf_counter()
+        for (docName, offset, char) in plan:
+            offset = min(offset, bk.docLength(docName))
+            bk.insertAt(docName, offset, char)
+            apply(sync.propagate(docName, 'insert', offset, char))
+            typedAt.append((docName, offset))
+        typed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for (docName, offset) in reversed(typedAt):
+            removed = bk.deleteAt(docName, offset, 1)
+            apply(sync.propagate(docName, 'delete', offset, removed))
+        deleted = time.perf_counter() - start
+    return {'keystroke insert': {'perKey': typed / keys, 'keys': keys},
+            'keystroke delete': {'perKey': deleted / keys, 'keys': keys},
+            'mirrored edits': mirrored[0],
+            'restored': all(bk.getDocText(docName) == text for (docName, text) in before.items()),
+            'counts still exact': bk.verifyCounts()}
+
+
+def benchTelemetry(samples, repeat):
+    with tempfile.TemporaryDirectory(prefix='telem') as path:
+        return benchWpm(main.TelemetryStore(path, 'bench'), samples, repeat)
+
+
+def benchWpm(store, samples, repeat):
+    # Telemetry.plot math without the drawing: the first extend() over a full session, then one frame's worth
+    t = 0.0
+    chars = 0
+    rng = random.Random(0)
+    for _ in range(samples):
+        t += rng.uniform(0.05, 0.5)
+        chars += rng.randint(0, 3)
+        store.append(t, chars, chars // 5)
+
+    def firstFrame():
+        wpm = main.WpmSeries()
+        wpm.extend(store)
+        wpm.smoothed()
+    results = {'wpm first frame': measure(firstFrame, repeat)}
+
+    wpm = main.WpmSeries()
+    wpm.extend(store)
+
+    def nextFrame():
+        for _ in range(10):
+            store.append(store.live('times')[-1] + 0.1, store.live('chars')[-1] + 1, 0)
+        wpm.extend(store)
+        wpm.smoothed()
+    results['wpm next frame'] = measure(nextFrame, repeat)
+    results['samples'] = samples
+    return results
+
+
+def benchSize(words, repeat, keys, samples):
+    workDir = tempfile.mkdtemp(prefix='writingapp-bench-')
+    cwd = os.getcwd()
+    os.chdir(workDir)
+    try:
+        start = time.perf_counter()
+        docs = generateBook(main.Book.basePath, words)
+        generated = time.perf_counter() - start
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            bk = main.Book()
+        try:
+            results = {'words': bk.getTotalWords()[1], 'chars': bk.getTotalWords()[0],
+                       'documents': len(docs), 'generate': generated}
+            results.update(benchLoad(bk, repeat))
+            results['getTotalWordsExpensive'] = measure(bk.getTotalWordsExpensive, repeat)
+            results['saveAll'] = measure(bk.saveAll, repeat)
+            results.update(benchTokenize(bk, repeat))
+            results.update(benchSearch(bk, repeat))
+            results.update(benchKeystrokes(bk, keys))
+        finally:
+            bk.saver.stop()
+        results.update(benchTelemetry(samples, repeat))
+        return results
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+def commitId():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Headless benchmarks for the writing app')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='manuscript sizes in words')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per timed operation')
+    parser.add_argument('--keys', type=int, default=2000, help='keystrokes per edit benchmark')
+    parser.add_argument('--samples', type=int, default=200000, help='telemetry samples for the WPM benchmark')
+    parser.add_argument('--out', default='bench_output.json', help='JSON file to write, - for stdout')
+    args = parser.parse_args()
+
+    report = {'commit': commitId(), 'python': platform.python_version(), 'platform': platform.platform(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'sizes': {}}
+    for words in args.sizes:
+        print('Benchmarking %d words...' % words, file=sys.stderr)
+        report['sizes'][str(words)] = benchSize(words, args.repeat, args.keys, args.samples)
+
+    text = json.dumps(report, indent=2)
+    if args.out == '-':
+        print(text)
+    else:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+        print('Wrote', args.out, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    run()
+
+
+
+# <GPLv3_Footer>
+#  - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+#                      Copyright (c) 2024 Nathan Ulmer.
+#  - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
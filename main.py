@@ -77,18 +77,1086 @@
 import tkinter as tk
 from tkinter import ttk
 from tkinter import font as tkFont
-import matplotlib.pyplot as plt
-import numpy as np
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg,NavigationToolbar2Tk)
 import math
-import keyboard
 from tkinter.filedialog import askopenfilename, asksaveasfilename
 
 
 
 import os
+import re
+import sys
 import time
+import select
+import stat
+import queue
+import collections
+import atexit
+import marshal
+import heapq
+import hashlib
+import argparse
+import functools
+import tempfile
+import threading
+import traceback
+
+# NumPy is only needed once telemetry starts and matplotlib once the Analysis tab is opened, so neither is imported at
+# launch. loadNumpy() sets np the first time it's called.
+np = None
+
+
+def loadNumpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+    return np
+
+
+class LatencyHistogram:
+    # Durations in log-spaced buckets from `low` seconds up, each `ratio` times wider than the one before, so a
+    # percentile read back is within half a bucket (about 5%) of the truth. Recording is one log and one list
+    # increment, no allocation, so it can stay on all the time.
+
+    low = 1e-5
+    ratio = 1.1
+    size = 200
+
+    def __init__(self):
+        self.counts = [0] * self.size
+        self.scale = 1.0 / math.log(self.ratio)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds <= self.low:
+            bucket = 0
+        else:
+            bucket = min(int(math.log(seconds / self.low) * self.scale) + 1, self.size - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        # Upper edge of the bucket holding the p-th percentile, capped at the largest value seen
+        if self.count == 0:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for (bucket, n) in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.low * self.ratio ** bucket, self.max)
+        return self.max
+
+
+class LatencyMonitor:
+    # A LatencyHistogram per instrumented hook. Hooks are wrapped with @timed(name), the Scheduler adds one per job
+    # plus 'tk.lateness' (how late the event loop ran a due job, i.e. how long Tk itself was busy) and the Application
+    # adds 'key.toIdle' (a keypress until Tk is idle again, which is after the redraw).
+
+    enabled = True
+
+    def __init__(self):
+        self.hists = {}
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        hist = self.hists.get(name)
+        if hist is None:
+            hist = self.hists[name] = LatencyHistogram()
+        hist.record(seconds)
+
+    def report(self):
+        lines = ['%-24s %8s %9s %9s %9s %9s' % ('hook', 'calls', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms')]
+        for name in sorted(self.hists):
+            hist = self.hists[name]
+            lines.append('%-24s %8d %9.2f %9.2f %9.2f %9.2f' % (name, hist.count, hist.percentile(50) * 1000,
+                                                                 hist.percentile(95) * 1000, hist.percentile(99) * 1000,
+                                                                 hist.max * 1000))
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            f.write(time.strftime('%Y-%m-%d %H:%M:%S') + '\n' + self.report() + '\n')
+
+
+latency = LatencyMonitor()
+
+
+def timed(name):
+    # Record the duration of every call of the decorated function under name
+    def wrap(fn):
+        @functools.wraps(fn)
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                latency.record(name, time.perf_counter() - start)
+        return call
+    return wrap
+
+class DocSaver:
+    # Writes dirty documents to disk from a background thread.
+    # Edits only mark a document (and section) dirty. Once the edits have settled for `debounce` seconds, or the
+    # document has been dirty for `maxDelay`, the UI thread hands a text snapshot of it to the worker.
+    # The worker doesn't touch the Book. The stamps of the files it wrote wait in `saved` until update() moves them
+    # into Book.fileStamps on the UI thread.
+
+    debounce = 0.5
+    maxDelay = 5.0
+
+    def __init__(self, book):
+        self.bk = book
+        self.dirty = {}
+        self.firstDirty = 0
+        self.lastDirty = 0
+        self.lock = threading.Lock()
+        self.jobs = queue.Queue()
+        self.saved = {}
+        # The umask can only be read by setting it, so that happens once here and not on the worker, where it would
+        # race with the other threads creating files
+        self.umask = os.umask(0)
+        os.umask(self.umask)
+        self.worker = threading.Thread(target=self.run, name='DocSaver', daemon=True)
+        self.worker.start()
+
+    def markDirty(self, docName, section=None):
+        now = time.time()
+        with self.lock:
+            if not self.dirty:
+                self.firstDirty = now
+            self.lastDirty = now
+            sections = self.dirty.setdefault(docName, set())
+            if section is not None:
+                sections.add(section)
+
+    def markClean(self, docName):
+        # The document matches its file again (it was just reloaded from it), there's nothing to write
+        with self.lock:
+            self.dirty.pop(docName, None)
+
+    def isDirty(self, docName=None):
+        with self.lock:
+            if docName is None:
+                return len(self.dirty) > 0
+            return docName in self.dirty
+
+    def update(self):
+        # Called from the UI thread. Cheap when nothing has changed.
+        if self.saved:
+            self.collectSaved()
+        if not self.dirty:
+            return
+        now = time.time()
+        if now - self.lastDirty >= self.debounce or now - self.firstDirty >= self.maxDelay:
+            self.submit()
+
+    def submit(self):
+        with self.lock:
+            docNames = list(self.dirty)
+            self.dirty = {}
+        for docName in docNames:
+            if docName in self.bk.docTree:
+                self.jobs.put((docName, self.bk.getDocText(docName)))
+
+    def flush(self):
+        # Write everything that is dirty right now and wait for the worker to finish
+        self.submit()
+        self.jobs.join()
+        self.collectSaved()
+
+    def collectSaved(self):
+        # Move the stamps of finished writes into the Book, UI thread only
+        with self.lock:
+            done = dict((docName, stamp) for (docName, stamp) in self.saved.items() if stamp[0] is not None)
+        # Into the Book first, so the watcher (which looks here first) always finds a stamp in one or the other
+        self.bk.fileStamps.update(done)
+        with self.lock:
+            for (docName, stamp) in done.items():
+                if self.saved.get(docName) == stamp:
+                    del self.saved[docName]
+
+    def savedStamp(self, docName):
+        # Stamp of a write of docName the Book doesn't know about yet, None if there isn't one
+        with self.lock:
+            return self.saved.get(docName)
+
+    def noteSaving(self, docName, text):
+        # Until the write lands the file keeps its old mtime, so it still looks unchanged; afterwards its hash matches
+        # and the watcher takes it as our own write
+        with self.lock:
+            self.saved[docName] = (None, None, self.bk.textHash(text))
+
+    def noteSaved(self, docName, text):
+        # So our own writes don't count as outside changes
+        try:
+            st = os.stat(self.bk.docPath(docName))
+        except OSError:
+            return
+        with self.lock:
+            self.saved[docName] = (st.st_mtime_ns, st.st_size, self.bk.textHash(text))
+
+    def stop(self):
+        self.flush()
+        self.jobs.put(None)
+        self.worker.join()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                docName, text = job
+                try:
+                    self.noteSaving(docName, text)
+                    self.writeAtomic(self.bk.docPath(docName), text)
+                    self.noteSaved(docName, text)
+                except OSError as e:
+                    print("Failed to save", docName, e)
+                    with self.lock:
+                        self.saved.pop(docName, None)
+                    self.markDirty(docName)
+            finally:
+                self.jobs.task_done()
+
+    def writeAtomic(self, path, text):
+        # Write to a temp file next to the target and rename it over the original so a crash can't leave a
+        # half-written chapter behind
+        dirName, fileName = os.path.split(path)
+        fd, tmpPath = tempfile.mkstemp(prefix='.' + fileName + '.', suffix='.tmp', dir=dirName or '.')
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                tmp.write(text)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            # mkstemp makes the file 0600, keep the mode the file had (or a new file would get) across the rename
+            try:
+                mode = stat.S_IMODE(os.stat(path).st_mode)
+            except FileNotFoundError:
+                mode = 0o666 & ~self.umask
+            os.chmod(tmpPath, mode)
+            os.replace(tmpPath, path)
+        except BaseException:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+
+class DocWatcher:
+    # Notices changes other programs (git pulls, other editors) make to the files in the Book's directory.
+    # A background thread blocks on inotify where it's available and polls every pollInterval seconds otherwise.
+    # Either way a file is only read when its mtime or size differ from the Book's stamp, and only reported when its
+    # content hash differs too. The UI thread collects the reports with changes() and applies them.
+    # The watcher thread only reads the Book. The stamps of what it has seen on disk are its own, the Book's are
+    # updated from the reports on the UI thread.
+
+    pollInterval = 1.0
+    # Let a burst of writes (a checkout touching many files) finish before scanning
+    settle = 0.2
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+
+    def __init__(self, book):
+        self.bk = book
+        self.reports = queue.Queue()
+        # docName -> stamp of the file as last read here, None once it was reported removed
+        self.stamps = {}
+        self.stopped = threading.Event()
+        self.worker = threading.Thread(target=self.run, name='DocWatcher', daemon=True)
+
+    def start(self):
+        self.worker.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.worker.is_alive():
+            self.worker.join()
+
+    def changes(self):
+        # (docName, text, stamp) for every file that changed since the last call, text None if it was removed
+        found = []
+        while True:
+            try:
+                found.append(self.reports.get_nowait())
+            except queue.Empty:
+                return found
+
+    def openInotify(self):
+        # inotify descriptor watching the book directory, None where inotify isn't available
+        if not sys.platform.startswith('linux'):
+            return None
+        # Imported here, ctypes.util pulls in subprocess which is noticeable at startup
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        mask = (self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO
+                | self.IN_CREATE | self.IN_DELETE)
+        if libc.inotify_add_watch(fd, os.fsencode(self.bk.basePath), mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def drain(self, fd):
+        # The events only say that something changed, scan() works out what
+        try:
+            while os.read(fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def run(self):
+        fd = self.openInotify()
+        try:
+            while not self.stopped.is_set():
+                if fd is None:
+                    self.stopped.wait(self.pollInterval)
+                else:
+                    (ready, _, _) = select.select([fd], [], [], self.pollInterval)
+                    if not ready:
+                        continue
+                    self.stopped.wait(self.settle)
+                    self.drain(fd)
+                if not self.stopped.is_set():
+                    try:
+                        self.scan()
+                    except Exception:
+                        traceback.print_exc()
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def scan(self):
+        names = self.bk.listDocs()
+        for docName in names:
+            try:
+                st = os.stat(self.bk.docPath(docName))
+            except OSError:
+                continue
+            seen = (self.stamps.get(docName), self.bk.saver.savedStamp(docName), self.bk.fileStamps.get(docName))
+            current = (st.st_mtime_ns, st.st_size)
+            if docName in self.bk.docTree and any(s is not None and s[:2] == current for s in seen):
+                if docName in self.stamps and self.stamps[docName] is None:
+                    # Back after it was reported removed, written again by our own save
+                    del self.stamps[docName]
+                continue
+            try:
+                (text, stamp) = self.bk.readDoc(docName)
+            except (OSError, ValueError):
+                # Gone again, or not text (UnicodeDecodeError); the other files still get scanned
+                continue
+            if self.stamps.get(docName) == stamp:
+                continue
+            self.stamps[docName] = stamp
+            # Looked up after the read: the saver notes the hash before it writes
+            known = [s[2] for s in (self.bk.saver.savedStamp(docName), self.bk.fileStamps.get(docName)) if s is not None]
+            if stamp[2] in known and docName in self.bk.docTree:
+                # Touched, or our own save, but the content is what the Book already has
+                continue
+            self.reports.put((docName, text, stamp))
+        for docName in set(self.bk.fileStamps) | set(self.stamps):
+            if docName not in names and self.stamps.get(docName, 1) is not None:
+                self.stamps[docName] = None
+                self.reports.put((docName, None, None))
+
+
+class TextBuffer:
+    # In-memory text of one Book section, stored as a chunked rope.
+    # Chunks hold at most maxChunk characters. A Fenwick tree over the chunk lengths finds the chunk holding an
+    # offset in O(log n), so an edit costs O(log n + maxChunk) however big the section is. The tree is only rebuilt
+    # when a chunk splits or empties, which is at most once per maxChunk / 2 inserted characters.
+    # A second tree over the newline count of each chunk maps line numbers to offsets the same way.
+    # str() joins the chunks and caches the result until the next edit.
+
+    maxChunk = 2048
+
+    def __init__(self, text=''):
+        self.setText(text)
+
+    def setText(self, text):
+        n = self.maxChunk // 2
+        self.chunks = [text[i:i + n] for i in range(0, len(text), n)] or ['']
+        self.length = len(text)
+        self.cache = text
+        self.rebuild()
+
+    def rebuild(self):
+        size = len(self.chunks)
+        tree = [0] * (size + 1)
+        lines = [0] * (size + 1)
+        for i in range(1, size + 1):
+            tree[i] += len(self.chunks[i - 1])
+            lines[i] += self.chunks[i - 1].count('\n')
+            j = i + (i & -i)
+            if j <= size:
+                tree[j] += tree[i]
+                lines[j] += lines[i]
+        self.tree = tree
+        self.lines = lines
+        self.top = 1 << (size.bit_length() - 1)
+
+    def addLength(self, chunk, delta, newlines=0):
+        i = chunk + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            self.lines[i] += newlines
+            i += i & -i
+
+    def prefix(self, tree, i):
+        total = 0
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def newlineCount(self):
+        return self.prefix(self.lines, len(self.chunks))
+
+    def newlinesBefore(self, pos):
+        (i, off) = self.find(min(max(pos, 0), self.length))
+        return self.prefix(self.lines, i) + self.chunks[i].count('\n', 0, off)
+
+    def newlineAt(self, k):
+        # Offset of the k-th (1-based) newline, O(log n + maxChunk)
+        i = 0
+        rem = k
+        step = self.top
+        while step:
+            j = i + step
+            if j < len(self.lines) and self.lines[j] < rem:
+                i = j
+                rem -= self.lines[j]
+            step >>= 1
+        chunk = self.chunks[i]
+        off = -1
+        for _ in range(rem):
+            off = chunk.index('\n', off + 1)
+        return self.prefix(self.tree, i) + off
+
+    def find(self, pos):
+        # (chunk index, offset within that chunk) for a text offset. pos == len(self) maps to the end of the last chunk.
+        i = 0
+        rem = pos
+        step = self.top
+        while step:
+            j = i + step
+            if j < len(self.tree) and self.tree[j] <= rem:
+                i = j
+                rem -= self.tree[j]
+            step >>= 1
+        if i == len(self.chunks):
+            return (i - 1, len(self.chunks[-1]))
+        return (i, rem)
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        if self.cache is None:
+            self.cache = ''.join(self.chunks)
+        return self.cache
+
+    def insert(self, pos, text):
+        if not text:
+            return
+        (i, off) = self.find(min(max(pos, 0), self.length))
+        chunk = self.chunks[i]
+        new = chunk[:off] + text + chunk[off:]
+        if len(new) <= self.maxChunk:
+            self.chunks[i] = new
+            self.addLength(i, len(text), text.count('\n'))
+        else:
+            n = self.maxChunk // 2
+            self.chunks[i:i + 1] = [new[k:k + n] for k in range(0, len(new), n)]
+            self.rebuild()
+        self.length += len(text)
+        self.cache = None
+
+    def delete(self, pos, length):
+        # Remove length characters at pos and return them
+        pos = min(max(pos, 0), self.length)
+        length = min(length, self.length - pos)
+        if length <= 0:
+            return ''
+        removed = []
+        (i, off) = self.find(pos)
+        remaining = length
+        emptied = False
+        while remaining > 0:
+            chunk = self.chunks[i]
+            take = min(remaining, len(chunk) - off)
+            if take > 0:
+                removed.append(chunk[off:off + take])
+                self.chunks[i] = chunk[:off] + chunk[off + take:]
+                self.addLength(i, -take, -removed[-1].count('\n'))
+                emptied = emptied or len(self.chunks[i]) == 0
+                remaining -= take
+            i += 1
+            off = 0
+        if emptied and len(self.chunks) > 1:
+            self.chunks = [c for c in self.chunks if c] or ['']
+            self.rebuild()
+        self.length -= length
+        self.cache = None
+        return ''.join(removed)
+
+    def slice(self, start, stop):
+        # Substring without materialising the whole buffer
+        start = min(max(start, 0), self.length)
+        stop = min(max(stop, start), self.length)
+        if self.cache is not None:
+            return self.cache[start:stop]
+        parts = []
+        (i, off) = self.find(start)
+        remaining = stop - start
+        while remaining > 0:
+            piece = self.chunks[i][off:off + remaining]
+            parts.append(piece)
+            remaining -= len(piece)
+            i += 1
+            off = 0
+        return ''.join(parts)
+
+
+class SectionIndex:
+    # Start offsets and line numbers of the '##' sections of one document.
+    # Fenwick trees over the per-section char and newline counts, so the section holding an offset or a line, and the
+    # offset or line a section starts at, are O(log n) however many sections the document has. An edit inside a
+    # section is one point update; only adding or removing sections rebuilds the trees.
+
+    def __init__(self, counts=()):
+        self.build(counts)
+
+    def build(self, counts):
+        # counts: (chars, newlines) of each section, in order
+        size = len(counts)
+        self.chars = [0] * (size + 1)
+        self.lines = [0] * (size + 1)
+        for i in range(1, size + 1):
+            self.chars[i] += counts[i - 1][0]
+            self.lines[i] += counts[i - 1][1]
+            j = i + (i & -i)
+            if j <= size:
+                self.chars[j] += self.chars[i]
+                self.lines[j] += self.lines[i]
+        self.size = size
+        self.top = 1 << size.bit_length()
+
+    def __len__(self):
+        return self.size
+
+    def add(self, section, dChars, dLines):
+        i = section + 1
+        while i <= self.size:
+            self.chars[i] += dChars
+            self.lines[i] += dLines
+            i += i & -i
+
+    def prefix(self, tree, i):
+        total = 0
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def search(self, tree, value):
+        # Number of leading sections whose running total is below value
+        idx = 0
+        rem = value
+        step = self.top
+        while step:
+            j = idx + step
+            if j <= self.size and tree[j] < rem:
+                idx = j
+                rem -= tree[j]
+            step >>= 1
+        return idx
+
+    def start(self, section):
+        return self.prefix(self.chars, section)
+
+    def linesBefore(self, section):
+        return self.prefix(self.lines, section)
+
+    def find(self, offset):
+        # Section holding an offset. An offset on a boundary belongs to the end of the earlier section.
+        return min(self.search(self.chars, offset), self.size - 1) if offset > 0 else 0
+
+    def findLine(self, line):
+        # Section holding the line-th (1-based) newline
+        return min(self.search(self.lines, line), self.size - 1)
+
+
+class IndexedSection:
+    # One section's entry in a SearchIndex: where it is, the offset of each of its words within it (starts, in order)
+    # and for each distinct word which of those it is (postings, word -> indexes into starts)
+    def __init__(self, docName, section):
+        self.docName = docName
+        self.section = section
+        self.postings = None
+        self.starts = None
+        # Position bucket the section's counts went to in WordStats, None if it isn't in one
+        self.bucket = None
+        # Changes every time the section is re-indexed, i.e. whenever its text may have changed
+        self.generation = 0
+
+
+class WordStats:
+    # Word frequencies for the Analysis tab, kept up to date by the SearchIndex. Each time it indexes or un-indexes a
+    # section, that section's word counts are added to or taken off the book-wide totals, and off the totals of the
+    # position bucket the section falls in if it's part of positionDoc. Keeping the statistics current therefore costs
+    # no more than re-indexing the changed sections.
+    # The buckets cut positionDoc into bucketCount equal stretches of text, so a word's counts across them show how
+    # its use changes over the runtime of the book. A section is assigned to the bucket its start falls in. Edits
+    # elsewhere can move that start, so rebucket() shifts whole sections between buckets when it has to.
+
+    positionDoc = 'book'
+    bucketCount = 20
+    # Left out of topWords(), still counted
+    stopWords = frozenset(('the', 'a', 'an', 'and', 'or', 'but', 'of', 'to', 'in', 'on', 'at', 'for', 'with', 'by',
+                           'from', 'as', 'is', 'was', 'were', 'be', 'been', 'are', 'it', 'its', 'that', 'this',
+                           'he', 'she', 'they', 'i', 'you', 'we', 'his', 'her', 'their', 'him', 'them', 'me', 'my',
+                           'not', 'had', 'have', 'has', 'do', 'did', 'so', 'if', 'then', 'than', 'there', 'what',
+                           'which', 'who', 'all', 'no', 's', 't', 'into', 'out', 'up', 'down', 'would', 'could'))
+
+    def __init__(self, book):
+        self.book = book
+        self.totals = {}
+        self.words = 0
+        self.buckets = [{} for _ in range(self.bucketCount)]
+        self.bucketWords = [0] * self.bucketCount
+        # Bumped on every change, so views can tell when they're out of date
+        self.version = 0
+
+    def bucketOf(self, entry):
+        length = self.book.docLength(entry.docName)
+        start = self.book.sectionStart(entry.docName, entry.section)
+        return min(start * self.bucketCount // max(length, 1), self.bucketCount - 1)
+
+    def count(self, table, postings, sign):
+        for (word, positions) in postings.items():
+            n = table.get(word, 0) + sign * len(positions)
+            if n:
+                table[word] = n
+            else:
+                del table[word]
+
+    def add(self, entry):
+        # Called once the entry's postings are set
+        self.count(self.totals, entry.postings, 1)
+        self.words += len(entry.starts)
+        if entry.docName == self.positionDoc:
+            entry.bucket = self.bucketOf(entry)
+            self.count(self.buckets[entry.bucket], entry.postings, 1)
+            self.bucketWords[entry.bucket] += len(entry.starts)
+        self.version += 1
+
+    def remove(self, entry):
+        # Called before the entry's postings are cleared
+        self.count(self.totals, entry.postings, -1)
+        self.words -= len(entry.starts)
+        if entry.bucket is not None:
+            self.count(self.buckets[entry.bucket], entry.postings, -1)
+            self.bucketWords[entry.bucket] -= len(entry.starts)
+            entry.bucket = None
+        self.version += 1
+
+    def rebucket(self, entries):
+        # Move the sections of positionDoc whose start has drifted into another bucket. O(sections), plus the counts
+        # of the sections that actually move.
+        for entry in entries:
+            if entry.postings is not None and not entry.bucket == self.bucketOf(entry):
+                self.remove(entry)
+                self.add(entry)
+
+    def topWords(self, n):
+        # The n most used words as (word, count), leaving out stopWords and numbers
+        return heapq.nlargest(n, ((word, count) for (word, count) in self.totals.items()
+                                  if word not in self.stopWords and not word.isdigit()), key=lambda item: item[1])
+
+    def usage(self, word):
+        # Uses of word per 1000 words in each bucket of positionDoc
+        return [1000.0 * bucket.get(word, 0) / words if words else 0.0
+                for (bucket, words) in zip(self.buckets, self.bucketWords)]
+
+
+def syllableCount(word):
+    # Vowel groups, less a silent final 'e'. The usual approximation for readability formulas.
+    word = word.lower().strip("'")
+    groups = len(re.findall('[aeiouy]+', word))
+    if groups > 1 and word.endswith('e') and not word.endswith(('le', 'ee')):
+        groups -= 1
+    return max(groups, 1)
+
+
+def readabilityCounts(text):
+    # (sentences, words, syllables, complex sentences) of a section's prose, leaving out '##' heading lines and
+    # markup. A sentence ends at '.', '!', '?' or a line break. It counts as complex when it's long, has a ';' or ':'
+    # or has a subordinate clause. Module level so worker processes can run it.
+    text = re.sub('^##.*$', '', text, flags=re.M)
+    text = re.sub(r'<\w+@|\[\w+\||[>\]]', ' ', text)
+    sentences = words = syllables = complexSentences = 0
+    for sentence in re.findall(r'[^.!?\n]+[.!?]*', text):
+        tokens = re.findall(r"[^\W\d_]+(?:'[^\W\d_]+)?", sentence)
+        if not tokens:
+            continue
+        sentences += 1
+        words += len(tokens)
+        syllables += sum(syllableCount(token) for token in tokens)
+        if len(tokens) > ReadabilityTracker.longSentence or ';' in sentence or ':' in sentence \
+                or any(token.lower() in ReadabilityTracker.subordinators for token in tokens):
+            complexSentences += 1
+    return (sentences, words, syllables, complexSentences)
+
+
+class ReadabilityTracker:
+    # Per-section readability of metricsDoc for the Analysis tab. Counts are cached by the content hash of each
+    # section, so only sections whose text changed are counted again, and the counting runs in a pool of worker
+    # processes so a long book never holds up the Tk loop. update() is called from the UI thread: it hands changed
+    # sections to the pool and picks up whatever has finished.
+    # A section is known to be unchanged when the SearchIndex hasn't re-indexed it since its hash was taken, so
+    # nothing is hashed but the sections that were edited.
+
+    metricsDoc = 'book'
+    workers = 2
+    longSentence = 25
+    subordinators = frozenset(('because', 'although', 'though', 'while', 'whereas', 'unless', 'since', 'whenever',
+                               'wherever', 'whether', 'which', 'whom', 'whose', 'until', 'if'))
+
+    def __init__(self, book):
+        self.book = book
+        # content hash -> counts, and -> future for counts still being worked out
+        self.cache = {}
+        self.running = {}
+        # IndexedSection -> (generation, content hash)
+        self.hashes = {}
+        self.pool = None
+        # The hash of each section of metricsDoc, in order
+        self.order = []
+        self.version = 0
+
+    def startPool(self):
+        # Spawned rather than forked, the app has threads running. Falls back to threads where processes can't start.
+        import concurrent.futures
+        import multiprocessing
+        try:
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        except (OSError, NotImplementedError, ImportError):
+            self.pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+
+    def submit(self, text):
+        import concurrent.futures
+        if self.pool is None:
+            self.startPool()
+        try:
+            return self.pool.submit(readabilityCounts, text)
+        except concurrent.futures.BrokenExecutor:
+            # A worker process died (killed for memory, say) and took the pool with it. Carry on with threads, which
+            # can't break that way; the sections that were lost are resubmitted.
+            print("Readability worker pool broke, continuing with threads")
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+            return self.pool.submit(readabilityCounts, text)
+
+    def update(self):
+        # True if the series changed since the last call
+        import concurrent.futures
+        changed = False
+        for (textHash, future) in list(self.running.items()):
+            if not future.done():
+                continue
+            del self.running[textHash]
+            try:
+                self.cache[textHash] = future.result()
+                changed = True
+            except concurrent.futures.BrokenExecutor:
+                # Resubmitted below, to a working pool
+                pass
+            except Exception:
+                traceback.print_exc()
+
+        search = self.book.search
+        search.refresh()
+        doc = self.metricsDoc
+        hashes = {}
+        order = []
+        for entry in search.docs.get(doc, ()):
+            known = self.hashes.get(entry)
+            text = None
+            if known is None or not known[0] == entry.generation:
+                text = str(self.book.docTree[doc][entry.section])
+                known = (entry.generation, self.book.textHash(text))
+            # Also catches sections whose counting was lost with a broken pool
+            if known[1] not in self.cache and known[1] not in self.running:
+                if text is None:
+                    text = str(self.book.docTree[doc][entry.section])
+                self.running[known[1]] = self.submit(text)
+            hashes[entry] = known
+            order.append(known[1])
+        self.hashes = hashes
+        if not order == self.order:
+            self.order = order
+            changed = True
+        # Drop the counts of text that's gone
+        if len(self.cache) > 2 * len(order) + 64:
+            live = set(order)
+            self.cache = dict((h, counts) for (h, counts) in self.cache.items() if h in live)
+        if changed:
+            self.version += 1
+        return changed
+
+    def scores(self, counts):
+        # (Flesch reading ease, Flesch-Kincaid grade, % complex sentences), None without any sentences
+        (sentences, words, syllables, complexSentences) = counts
+        if not sentences or not words:
+            return None
+        perSentence = words / sentences
+        perWord = syllables / words
+        return (206.835 - 1.015 * perSentence - 84.6 * perWord, 0.39 * perSentence + 11.8 * perWord - 15.59,
+                100.0 * complexSentences / sentences)
+
+    def series(self):
+        # Scores of each section of metricsDoc, None where they're still being worked out or there's no prose
+        return [self.scores(self.cache[h]) if h in self.cache else None for h in self.order]
+
+    def overall(self):
+        # Scores of metricsDoc as a whole, from the sections counted so far
+        totals = [0, 0, 0, 0]
+        for h in self.order:
+            for (i, n) in enumerate(self.cache.get(h, ())):
+                totals[i] += n
+        return self.scores(totals)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class SearchIndex:
+    # Inverted index over the words of every Book document: word -> the sections holding it, and in each section the
+    # positions of the word. Positions are word numbers within the section, so a phrase is a set intersection, and
+    # they map to offsets relative to the section start. Nothing is relative to the document, so an edit only ever
+    # invalidates the section it lands in, and all an edit does here is mark that section stale. Stale sections are
+    # re-tokenized by refresh(), from an idle job or at the latest by the next query. Hits are turned into document
+    # offsets through the Book's SectionIndex, O(log n) each.
+    # With cacheName set the postings are written to that file in the book directory on close, keyed by each
+    # document's content hash, and a restart takes them from there for every document that hasn't changed.
+    # The word counts of the Analysis tab (WordStats) are kept up to date as sections are indexed.
+
+    # Words, leaving out the tag names of '<bold@ ...>' markup
+    wordPattern = re.compile(r'(?<![<\w])\w+(?![@\w])')
+    cacheName = '.searchindex'
+    cacheVersion = 1
+
+    def __init__(self, book):
+        self.book = book
+        self.words = {}
+        self.docs = {}
+        self.stale = set()
+        self.stats = WordStats(book)
+        self.generation = 0
+        # Documents none of whose sections have been tokenized yet, the only ones the cache can fill in
+        self.unindexed = set()
+        self.cache = None
+
+    def terms(self, text):
+        return [m.group().lower() for m in self.wordPattern.finditer(text)]
+
+    def tokenize(self, text):
+        # (postings, starts) of a section's text
+        postings = {}
+        starts = []
+        for m in self.wordPattern.finditer(text):
+            word = m.group().lower()
+            positions = postings.get(word)
+            if positions is None:
+                postings[word] = [len(starts)]
+            else:
+                positions.append(len(starts))
+            starts.append(m.start())
+        return (postings, starts)
+
+    def add(self, entry, postings, starts):
+        entry.postings = postings
+        entry.starts = starts
+        self.generation += 1
+        entry.generation = self.generation
+        self.stats.add(entry)
+        for word in postings:
+            holders = self.words.get(word)
+            if holders is None:
+                self.words[word] = {entry}
+            else:
+                holders.add(entry)
+
+    def remove(self, entry):
+        if entry.postings is not None:
+            self.stats.remove(entry)
+            for word in entry.postings:
+                holders = self.words[word]
+                holders.discard(entry)
+                if not holders:
+                    del self.words[word]
+            entry.postings = None
+            entry.starts = None
+        self.stale.discard(entry)
+
+    def setDoc(self, docName, count):
+        # The document was (re)parsed into count sections
+        self.dropDoc(docName)
+        entries = [IndexedSection(docName, section) for section in range(count)]
+        self.docs[docName] = entries
+        self.stale.update(entries)
+        self.unindexed.add(docName)
+
+    def dropDoc(self, docName):
+        for entry in self.docs.pop(docName, []):
+            self.remove(entry)
+        self.unindexed.discard(docName)
+
+    def touch(self, docName, section):
+        # Text in the section changed
+        entries = self.docs.get(docName)
+        if entries is not None:
+            self.stale.add(entries[section])
+            self.unindexed.discard(docName)
+
+    def resplit(self, docName, first, last, count):
+        # Sections first..last were replaced by count new ones
+        entries = self.docs.get(docName)
+        if entries is None:
+            return
+        for entry in entries[first:last + 1]:
+            self.remove(entry)
+        fresh = [IndexedSection(docName, first + i) for i in range(count)]
+        entries[first:last + 1] = fresh
+        for section in range(first + count, len(entries)):
+            entries[section].section = section
+        self.stale.update(fresh)
+        self.unindexed.discard(docName)
+
+    def refresh(self, budget=None):
+        # Tokenize stale sections, for at most budget seconds if given. True once nothing is stale.
+        if self.cache is None:
+            self.cache = self.readCache()
+        for docName in list(self.unindexed):
+            if docName in self.cache:
+                self.useCached(docName, *self.cache.pop(docName))
+        deadline = None if budget is None else time.perf_counter() + budget
+        while self.stale:
+            if deadline is not None and time.perf_counter() > deadline:
+                return False
+            entry = self.stale.pop()
+            self.remove(entry)
+            self.add(entry, *self.tokenize(str(self.book.docTree[entry.docName][entry.section])))
+            self.unindexed.discard(entry.docName)
+        return True
+
+    def useCached(self, docName, textHash, sections):
+        self.unindexed.discard(docName)
+        entries = self.docs[docName]
+        if not len(sections) == len(entries) or not textHash == self.book.textHash(self.book.getDocText(docName)):
+            return
+        for (entry, (postings, starts)) in zip(entries, sections):
+            self.stale.discard(entry)
+            self.add(entry, postings, starts)
+
+    def updateStats(self):
+        # Bring the WordStats up to date, costs what changed since the last call
+        self.refresh()
+        self.stats.rebucket(self.docs.get(self.stats.positionDoc, ()))
+        return self.stats
+
+    def cachePath(self):
+        return os.path.join(self.book.basePath, self.cacheName)
+
+    def readCache(self):
+        # {docName: (hash, [(postings, starts) of each section])}, empty if there's no usable cache. marshal rather than pickle:
+        # it's as fast for plain dicts and lists and loading it can't run code from the book directory.
+        if self.cacheName is None:
+            return {}
+        try:
+            with open(self.cachePath(), 'rb') as f:
+                # loads() of the whole file, load() straight from the file is many times slower
+                (version, docs) = marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return {}
+        return docs if version == self.cacheVersion else {}
+
+    def save(self):
+        if self.cacheName is None:
+            return
+        self.refresh()
+        docs = {}
+        for (docName, entries) in self.docs.items():
+            docs[docName] = (self.book.textHash(self.book.getDocText(docName)),
+                             [(entry.postings, entry.starts) for entry in entries])
+        # Kept for documents that are still waiting to be parsed
+        for (docName, cached) in (self.cache or {}).items():
+            docs.setdefault(docName, cached)
+        path = self.cachePath()
+        tmp = os.path.join(self.book.basePath, '.' + self.cacheName.lstrip('.') + '.tmp')
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(marshal.dumps((self.cacheVersion, docs)))
+            os.replace(tmp, path)
+        except OSError as e:
+            print("Failed to write the search index", e)
+
+    def phrases(self, entry, terms):
+        # Word numbers in the section where the phrase terms starts. Walks the rarest word's positions and keeps those
+        # the other words follow in order.
+        k = min(range(len(terms)), key=lambda j: len(entry.postings[terms[j]]))
+        found = [p - k for p in entry.postings[terms[k]] if p >= k]
+        for (j, term) in enumerate(terms):
+            if j == k:
+                continue
+            positions = set(entry.postings[term])
+            found = [p for p in found if p + j in positions]
+        return found
+
+    @timed('SearchIndex.search')
+    def search(self, query, limit=200):
+        # Up to limit hits (docName, section, start, end) for the words of query as a phrase, in document order.
+        # Words match whole and case-insensitively.
+        terms = self.terms(query)
+        if not terms:
+            return []
+        self.refresh()
+        holders = [self.words.get(term) for term in terms]
+        if not all(holders):
+            return []
+        candidates = set.intersection(*sorted(holders, key=len))
+        order = dict((docName, i) for (i, docName) in enumerate(self.book.allPaths))
+        hits = []
+        for entry in sorted(candidates, key=lambda e: (order.get(e.docName, len(order)), e.docName, e.section)):
+            start = self.book.sectionStart(entry.docName, entry.section)
+            found = entry.postings[terms[0]] if len(terms) == 1 else self.phrases(entry, terms)
+            for p in found:
+                last = entry.starts[p + len(terms) - 1]
+                hits.append((entry.docName, entry.section, start + entry.starts[p], start + last + len(terms[-1])))
+                if len(hits) >= limit:
+                    return hits
+        return hits
+
 
 class Book:
 
@@ -102,28 +1170,120 @@ class Book:
 
     docTree = {}
 
-    def __init__(self):
+    # Per-section (chars, words) kept in step with docTree so totals don't need a full re-split
+    sectionCounts = {}
+    totalChars = 0
+    totalWords = 0
+
+    # Per-document index of the '[' '|' ']' link delimiters, kept in step with document-level edits
+    links = {}
+
+    # Per-document SectionIndex of where each '##' section starts, and a counter bumped whenever the list of
+    # sections or one of their headings changes so the navigator knows when to refresh
+    sections = {}
+    sectionVersion = {}
+
+    saver = None
+    search = None
 
-        for (a,b,file) in os.walk('./book'):
-            self.allPaths = file
-        self.loadDocTree()
+    # (mtime, size, content hash) of each file as last loaded or saved, so loadDocTree only re-parses changed files
+    fileStamps = {}
 
-        print("Total Chars Slow: ", self.getTotalWordsExpensive()[0])
-        print("Total Words Slow: ", self.getTotalWordsExpensive()[1])
+    def __init__(self, docNames=None):
+        # With docNames only those documents are parsed now, the rest wait for loadInBackground()
+
+        self.basePath = self.findBasePath()
+        self.docTree = {}
+        self.sectionCounts = {}
+        self.links = {}
+        self.sections = {}
+        self.sectionVersion = {}
+        self.fileStamps = {}
+        self.pending = []
+        self.loaded = queue.Queue()
+        self.loader = None
+        self.search = SearchIndex(self)
+        self.loadDocTree(docNames)
+        self.saver = DocSaver(self)
+
+        if not self.pending:
+            self.printTotals()
         #self.saveAll()
 
+    def printTotals(self):
+        print("Total Chars: ", self.getTotalWords()[0])
+        print("Total Words: ", self.getTotalWords()[1])
+
+
+    def findBasePath(self):
+        # The repo ships its documents in Book/. basePath is matched case-insensitively so they're found on
+        # case-sensitive filesystems too; an exact match wins.
+        if os.path.isdir(self.basePath):
+            return self.basePath
+        (parent, name) = os.path.split(self.basePath)
+        try:
+            entries = sorted(os.listdir(parent or '.'))
+        except OSError:
+            return self.basePath
+        for entry in entries:
+            if entry.lower() == name.lower() and os.path.isdir(os.path.join(parent, entry)):
+                return os.path.join(parent, entry)
+        return self.basePath
+
+    def listDocs(self):
+        # Every plain file in basePath is a document. Dot files are skipped, they're the saver's temp files.
+        if not os.path.isdir(self.basePath):
+            return []
+        return sorted(name for name in os.listdir(self.basePath)
+                      if not name.startswith('.') and os.path.isfile(os.path.join(self.basePath, name)))
+
+    def docPath(self, docName):
+        return os.path.join(self.basePath, docName)
+
+    def textHash(self, text):
+        return hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def readDoc(self, docName):
+        # The whole file in one read, with the stamp it was read at
+        path = self.docPath(docName)
+        st = os.stat(path)
+        with open(path, 'r') as f:
+            text = f.read()
+        return (text, (st.st_mtime_ns, st.st_size, self.textHash(text)))
+
+    def fileChanged(self, docName):
+        # Cheap check: a file whose mtime and size match the stamp hasn't been touched since we loaded or saved it
+        stamp = self.fileStamps.get(docName)
+        if stamp is None or docName not in self.docTree:
+            return True
+        try:
+            st = os.stat(self.docPath(docName))
+        except OSError:
+            return True
+        return not (st.st_mtime_ns, st.st_size) == stamp[:2]
+
+    def keepDiskCopy(self, docName, text):
+        # Save text, a version of docName found on disk, under a new name next to it and return its path. It isn't a
+        # dot file, so it shows up as a document of its own.
+        path = self.docPath('%s.disk-%s' % (docName, time.strftime('%Y%m%d-%H%M%S')))
+        n = 1
+        while os.path.exists(path):
+            n += 1
+            path = self.docPath('%s.disk-%s-%d' % (docName, time.strftime('%Y%m%d-%H%M%S'), n))
+        self.saver.writeAtomic(path, text)
+        return path
 
     def loadAllString(self):
-        self.allString = ""
+        parts = []
         for doc in self.allPaths:
-            with open(os.path.join(self.basePath, doc), 'r') as doc:
-                for line in doc:
-                    self.allString = self.allString + line
-            self.allString = self.allString + "\n"
+            with open(self.docPath(doc), 'r') as f:
+                parts.append(f.read())
+            parts.append("\n")
+        self.allString = ''.join(parts)
 
         return self.allString
 
-    def loadDocTree(self):
+    def loadDocTree(self, docNames=None):
         # Document A
         #  Section A
         #    Unstructured Part A
@@ -134,141 +1294,1535 @@ class Book:
         #    ...
         # Document B
         #  ...
-        self.docTree = {}
-        for doc in self.allPaths:
-            docList = []
-            currentSection = ""
-            with open(os.path.join(self.basePath, doc), 'r') as doc:
-                for line in doc:
-                    if line.startswith("##"):
-                        if not currentSection == '':
-                            docList.append(currentSection)
-                        currentSection = line
-                    else:
-                        currentSection = currentSection + line
-                docList.append(currentSection)
-            self.docTree[doc.name.split('\\')[1]] = docList.copy()
+        # Files whose mtime and size haven't changed since the last load are skipped. A file that was touched but
+        # whose content hash is the same isn't re-parsed either.
+        # With docNames only those are loaded and the other new files are left pending.
+        self.allPaths = self.listDocs()
+        names = self.allPaths if docNames is None else [d for d in self.allPaths if d in docNames]
+        self.pending = [d for d in self.allPaths if d not in names and d not in self.docTree]
+        for docName in names:
+            if not self.fileChanged(docName):
+                continue
+            (text, stamp) = self.readDoc(docName)
+            old = self.fileStamps.get(docName)
+            self.fileStamps[docName] = stamp
+            if old is not None and old[2] == stamp[2] and docName in self.docTree:
+                continue
+            self.parseDoc(docName, text)
+        for docName in list(self.fileStamps):
+            if docName not in self.allPaths:
+                self.dropDoc(docName)
         return self.docTree
 
+    def loadInBackground(self):
+        # Read and parse the pending documents on a worker thread. installLoaded() puts them in the Book from the UI
+        # thread, so the Book itself is only ever changed there.
+        if self.pending and self.loader is None:
+            self.loader = threading.Thread(target=self.loadPending, args=(list(self.pending),), name='BookLoader',
+                                           daemon=True)
+            self.loader.start()
+
+    def loadPending(self, docNames):
+        # A document that can't be read, decoded or parsed is skipped, it mustn't keep the rest from loading
+        for docName in docNames:
+            try:
+                (text, stamp) = self.readDoc(docName)
+                parsed = self.buildDoc(text)
+            except Exception as e:
+                print("Failed to load", docName, e)
+                self.loaded.put((docName, None, None))
+                continue
+            self.loaded.put((docName, stamp, parsed))
+
+    def installLoaded(self):
+        # Called from the UI thread, True once no documents are pending
+        while True:
+            try:
+                (docName, stamp, parsed) = self.loaded.get_nowait()
+            except queue.Empty:
+                break
+            if docName in self.pending:
+                self.pending.remove(docName)
+            # Skip it if it failed, or was loaded some other way in the meantime
+            if parsed is None or docName in self.docTree:
+                continue
+            self.fileStamps[docName] = stamp
+            self.installDoc(docName, parsed)
+        return not self.pending
+
+    def recountAll(self):
+        # Rebuild the per-section counts from scratch, only needed after a full (re)load
+        self.sectionCounts = {}
+        self.totalChars = 0
+        self.totalWords = 0
+        for k in self.docTree:
+            self.sectionCounts[k] = []
+            for section in self.docTree[k]:
+                counts = [len(section), len(str(section).split())]
+                self.sectionCounts[k].append(counts)
+                self.totalChars += counts[0]
+                self.totalWords += counts[1]
+        self.links = {}
+        self.sections = {}
+        for k in self.docTree:
+            self.rebuildLinks(k)
+            self.reindex(k)
+
+    def rebuildLinks(self, docName):
+        self.links[docName] = MarkupIndex('[', '|', ']')
+        self.links[docName].rebuild(self.getDocText(docName))
+
+    def reindex(self, docName):
+        # Rebuild the section index from the per-section counts, O(sections)
+        counts = [(c[0], section.newlineCount()) for (c, section) in zip(self.sectionCounts[docName], self.docTree[docName])]
+        self.sections[docName] = SectionIndex(counts)
+        self.sectionVersion[docName] = self.sectionVersion.get(docName, 0) + 1
+
+    def splitSections(self, text):
+        # A new section starts at every line beginning with '##'. Lines end at '\n' only, like reading the file does.
+        # One regex pass for the heading offsets, then one slice per section.
+        starts = [0] + [m.start() for m in re.finditer('^##', text, re.M) if m.start() > 0]
+        ends = starts[1:] + [len(text)]
+        return [text[start:end] for (start, end) in zip(starts, ends)]
+
+    def getSection(self, docName, section):
+        return str(self.docTree[docName][section])
+
+    def docLength(self, docName):
+        index = self.sections[docName]
+        return index.start(len(index))
+
+    def getDocText(self, docName):
+        return ''.join(str(section) for section in self.docTree[docName])
+
+    def setDocText(self, docName, text):
+        # Replace a whole document, re-splitting it into sections
+        self.parseDoc(docName, text)
+        self.markDirty(docName)
+
+    def parseDoc(self, docName, text):
+        # Split text into the document's sections and bring its counts and indexes up to date, without marking it dirty
+        self.installDoc(docName, self.buildDoc(text))
+
+    def buildDoc(self, text):
+        # Sections, counts and indexes of a document's text. Doesn't touch the Book, so it can run on a worker thread.
+        sections = [TextBuffer(section) for section in self.splitSections(text)]
+        counts = [[len(section), len(str(section).split())] for section in sections]
+        links = MarkupIndex('[', '|', ']')
+        links.rebuild(text)
+        index = SectionIndex([(c[0], section.newlineCount()) for (c, section) in zip(counts, sections)])
+        return (sections, counts, links, index)
+
+    def installDoc(self, docName, parsed):
+        (sections, counts, links, index) = parsed
+        for old in self.sectionCounts.get(docName, []):
+            self.totalChars -= old[0]
+            self.totalWords -= old[1]
+        for c in counts:
+            self.totalChars += c[0]
+            self.totalWords += c[1]
+        self.docTree[docName] = sections
+        self.sectionCounts[docName] = counts
+        self.links[docName] = links
+        self.sections[docName] = index
+        self.sectionVersion[docName] = self.sectionVersion.get(docName, 0) + 1
+        self.search.setDoc(docName, len(sections))
+
+    def changedRange(self, docName, text):
+        # (start, end, replacement) of the one span where the document differs from text, None if they're the same
+        span = diffSpan(self.getDocText(docName), text)
+        if span is None:
+            return None
+        (start, end, newEnd) = span
+        return (start, end, text[start:newEnd])
+
+    def dropDoc(self, docName):
+        # Forget a document whose file has gone away
+        for counts in self.sectionCounts.pop(docName, []):
+            self.totalChars -= counts[0]
+            self.totalWords -= counts[1]
+        for table in (self.docTree, self.links, self.sections, self.fileStamps):
+            table.pop(docName, None)
+        self.search.dropDoc(docName)
+
+    def markDirty(self, docName, section=None):
+        if self.saver is not None:
+            self.saver.markDirty(docName, section)
 
     def saveDoc(self,docName):
-        with open(os.path.join(self.basePath, docName), 'w') as doc:
-            for section in self.docTree[docName]:
-                doc.writelines(section)
+        # Synchronous save, goes through the saver so it never races a background write of the same file
+        self.markDirty(docName)
+        self.saver.flush()
 
+    @timed('Book.saveAll')
     def saveAll(self):
         for docName in self.allPaths:
-            self.saveDoc(docName)
+            self.markDirty(docName)
+        self.saver.flush()
 
     def getTotalWordsExpensive(self):
+        # Full re-split of every section. Kept as the reference the incremental counts are checked against.
         totalWords = 0
         totalChars = 0
         for k in self.docTree:
             for section in self.docTree[k]:
-                totalWords += len(section.split())
+                totalWords += len(str(section).split())
                 totalChars += len(section)
         return (totalChars, totalWords)
 
+    def getTotalWords(self):
+        return (self.totalChars, self.totalWords)
+
+    def verifyCounts(self):
+        return self.getTotalWords() == self.getTotalWordsExpensive()
+
+    def wordWindow(self, buf, start, end):
+        # (offset, text) of buf[start:end] widened out to the surrounding whitespace, so every word an edit in that
+        # range touches is whole. Reads in small blocks, cost is the range plus the partial words at its ends.
+        block = 64
+        while start > 0:
+            left = buf.slice(max(0, start - block), start)
+            k = len(left)
+            while k > 0 and not left[k - 1].isspace():
+                k -= 1
+            start -= len(left) - k
+            if k > 0:
+                break
+        while end < len(buf):
+            right = buf.slice(end, end + block)
+            k = 0
+            while k < len(right) and not right[k].isspace():
+                k += 1
+            end += k
+            if k < len(right):
+                break
+        return (start, buf.slice(start, end))
+
+    def adjustCounts(self, doc, section, dChars, dWords, dLines=0):
+        counts = self.sectionCounts[doc][section]
+        counts[0] += dChars
+        counts[1] += dWords
+        self.totalChars += dChars
+        self.totalWords += dWords
+        self.sections[doc].add(section, dChars, dLines)
+
     def setSection(self,doc,section,text):
-        self.docTree[doc][section] = text
+        old = self.sectionCounts[doc][section]
+        oldLines = self.docTree[doc][section].newlineCount()
+        self.docTree[doc][section] = TextBuffer(text)
+        self.adjustCounts(doc, section, len(text) - old[0], len(text.split()) - old[1], text.count('\n') - oldLines)
+        self.rebuildLinks(doc)
+        self.markDirty(doc, section)
+        self.search.touch(doc, section)
+        start = self.sections[doc].start(section)
+        self.checkSections(doc, start, start + len(text))
 
     def addChar(self, doc, section, idx, text):
-        self.docTree[doc][section] = self.docTree[doc][section][:idx] + text + self.docTree[doc][section][idx:]
+        buf = self.docTree[doc][section]
+        idx = min(max(idx, 0), len(buf))
+        (start, window) = self.wordWindow(buf, idx, idx)
+        rel = idx - start
+        dWords = len((window[:rel] + text + window[rel:]).split()) - len(window.split())
+        buf.insert(idx, text)
+        self.adjustCounts(doc, section, len(text), dWords, text.count('\n'))
+        self.markDirty(doc, section)
+        self.search.touch(doc, section)
+
+    def rmText(self, doc, section, idx, length):
+        buf = self.docTree[doc][section]
+        if idx < 0 or idx >= len(buf) or length <= 0:
+            return ''
+        length = min(length, len(buf) - idx)
+        (start, window) = self.wordWindow(buf, idx, idx + length)
+        rel = idx - start
+        dWords = len((window[:rel] + window[rel + length:]).split()) - len(window.split())
+        removed = buf.delete(idx, length)
+        self.adjustCounts(doc, section, -length, dWords, -removed.count('\n'))
+        self.markDirty(doc, section)
+        self.search.touch(doc, section)
+        return removed
 
     def rmChar(self, doc, section, idx):
-        self.docTree[doc][section] = self.docTree[doc][section][:idx] + self.docTree[doc][section][idx+1:]
+        self.rmText(doc, section, idx, 1)
+
+    def locate(self, doc, offset):
+        # (section, offset within section) for an offset into the whole document. An offset on a boundary belongs to
+        # the end of the earlier section, so typing before a '##' heading extends the previous section.
+        index = self.sections[doc]
+        section = index.find(offset)
+        return (section, offset - index.start(section))
+
+    def sectionStart(self, doc, section):
+        return self.sections[doc].start(section)
+
+    def sectionTitle(self, doc, section):
+        # Heading text of a section without the '#'s, '' for text in front of the first heading
+        head = self.docTree[doc][section].slice(0, 256).split('\n', 1)[0]
+        if not head.startswith('##'):
+            return ''
+        return head.lstrip('#').strip()
+
+    def offsetOf(self, doc, line, col):
+        # Document offset of a Tk 'line.col' index, lines count from 1
+        index = self.sections[doc]
+        if line <= 1:
+            return col
+        if line - 1 > index.linesBefore(len(index)):
+            return self.docLength(doc)
+        section = index.findLine(line - 1)
+        k = line - 1 - index.linesBefore(section)
+        return index.start(section) + self.docTree[doc][section].newlineAt(k) + 1 + col
+
+    def indexOf(self, doc, offset):
+        # (line, col) of a document offset, the inverse of offsetOf
+        offset = min(max(offset, 0), self.docLength(doc))
+        (section, idx) = self.locate(doc, offset)
+        line = self.sections[doc].linesBefore(section) + self.docTree[doc][section].newlinesBefore(idx) + 1
+        return (line, offset - self.offsetOf(doc, line, 0))
+
+    def sectionAt(self, doc, line, col):
+        return self.locate(doc, self.offsetOf(doc, line, col))[0]
+
+    def checkSections(self, doc, start, end):
+        # After an edit that left [start, end) holding new text, split or merge sections so they follow the same
+        # '##' rule as splitSections. Only line starts within a couple of characters of the edit can have gained or
+        # lost a heading, so those are compared with the index first and the text is re-split only on a mismatch.
+        index = self.sections[doc]
+        length = index.start(len(index))
+        lo = max(0, start - 2)
+        hi = min(length, end + 2)
+        first = index.find(lo)
+        last = len(index) - 1 if hi == length else index.find(hi)
+        starts = [index.start(s) for s in range(first + 1, last + 1)]
+        base = max(0, lo - 1)
+        window = self.slice(doc, base, hi + 2)
+        heads = [base + m.end() for m in re.finditer('\n(?=##)', window) if lo <= base + m.end() < hi]
+        if not starts == heads:
+            self.resplit(doc, first, last)
+            return
+        # Typing in a heading line renames the section
+        section = index.find(start)
+        if self.docTree[doc][section].newlinesBefore(start - index.start(section)) == 0:
+            self.sectionVersion[doc] += 1
+
+    def resplit(self, doc, first, last):
+        # Replace sections first..last with a fresh split of their text. Costs the size of those sections only.
+        text = ''.join(str(section) for section in self.docTree[doc][first:last + 1])
+        pieces = self.splitSections(text)
+        for counts in self.sectionCounts[doc][first:last + 1]:
+            self.totalChars -= counts[0]
+            self.totalWords -= counts[1]
+        counts = [[len(piece), len(piece.split())] for piece in pieces]
+        for c in counts:
+            self.totalChars += c[0]
+            self.totalWords += c[1]
+        self.docTree[doc][first:last + 1] = [TextBuffer(piece) for piece in pieces]
+        self.sectionCounts[doc][first:last + 1] = counts
+        self.search.resplit(doc, first, last, len(pieces))
+        self.reindex(doc)
+        self.markDirty(doc)
+
+    def insertAt(self, doc, offset, text):
+        # Takes a whole block (a paste, a reload) as one edit: one rope insert and one word-count window
+        (section, idx) = self.locate(doc, offset)
+        self.addChar(doc, section, idx, text)
+        self.links[doc].onInsert(offset, text)
+        self.checkSections(doc, offset, offset + len(text))
+
+    def deleteAt(self, doc, offset, length):
+        # Document-level delete, may span several sections. Returns the removed text.
+        parts = []
+        last = len(self.sectionCounts[doc]) - 1
+        while length > 0:
+            (section, idx) = self.locate(doc, offset)
+            while idx == self.sectionCounts[doc][section][0] and section < last:
+                (section, idx) = (section + 1, 0)
+            removed = self.rmText(doc, section, idx, length)
+            if not removed:
+                break
+            parts.append(removed)
+            length -= len(removed)
+        removed = ''.join(parts)
+        if removed:
+            self.links[doc].onDelete(offset, removed)
+            self.checkSections(doc, offset, offset)
+        return removed
+
+    def slice(self, doc, start, end):
+        # Text of [start, end) of a whole document without joining it
+        parts = []
+        (section, idx) = self.locate(doc, start)
+        remaining = end - start
+        while remaining > 0 and section < len(self.docTree[doc]):
+            piece = self.docTree[doc][section].slice(idx, idx + remaining)
+            parts.append(piece)
+            remaining -= len(piece)
+            section += 1
+            idx = 0
+        return ''.join(parts)
+
+
+class SyncEngine:
+    # Two-way sync between [target|text] passages in the notes and the ']'-terminated segments of their target (the
+    # book). The passage closed by the n-th ']' of a source document is anchored to the n-th segment of each target.
+    # Both ends come from Book.links, so finding the other side of an edit is a handful of O(log n) lookups.
+    # An edit inside a passage or a segment is mirrored as the same insert/delete at the same relative offset, and
+    # only if both sides held the same text before it. Leading newlines don't count: every segment after a ']\n'
+    # starts with one that its passage doesn't have. A pair that differs is left alone and reported once, closing
+    # the link again copies it over with linkClosed(). Edits that add or remove link delimiters change the anchoring
+    # itself and are not mirrored.
+    # Results are (doc, start, end, text) edits: replace [start, end) of doc with text.
+
+    def __init__(self, book):
+        self.bk = book
+        # (source, target, n) of the pairs found to differ, so each is reported once
+        self.mismatched = set()
+
+    def passage(self, doc, n):
+        # (opener, separator, closer) offsets of the link closed by the n-th ']' of doc, or None
+        links = self.bk.links[doc]
+        if n >= links.closerCount():
+            return None
+        close = links.position(links.nthCloser(n))
+        found = links.findOpener(close)
+        if found is None or found[1] is None:
+            return None
+        return (found[0], found[1], close)
+
+    def targetsOf(self, doc, passage):
+        return self.bk.slice(doc, passage[0] + 1, passage[1]).split(',')
+
+    def lead(self, text):
+        return len(text) - len(text.lstrip('\n'))
+
+    def linkClosed(self, doc, n):
+        # Copy the whole of passage n into each target segment, after the segment's leading newlines
+        passage = self.passage(doc, n)
+        if passage is None:
+            return []
+        text = self.bk.slice(doc, passage[1] + 1, passage[2])
+        text = text[self.lead(text):]
+        edits = []
+        for target in self.targetsOf(doc, passage):
+            if target == doc or target not in self.bk.docTree:
+                continue
+            found = self.bk.links[target].segmentRange(n, self.bk.docLength(target))
+            if found is None:
+                continue
+            (start, end, closed) = found
+            start += self.lead(self.bk.slice(target, start, end))
+            self.mismatched.discard((doc, target, n))
+            edits.append((target, start, end, text if closed else text + ']'))
+        return edits
+
+    def propagate(self, doc, op, offset, text):
+        # doc has already been edited. Returns the mirrored edits for the other side(s).
+        if op not in ('insert', 'delete') or re.search('[\\[|\\]]', text):
+            return []
+        length = len(text) if op == 'insert' else 0
+        return self.forward(doc, op, offset, text, length) + self.reverse(doc, op, offset, text, length)
+
+    def mirror(self, op, span, rel, otherDoc, otherStart, otherEnd, text):
+        # span is the edited side's text after the edit, which was at rel within it. The same edit at the same offset
+        # from the start of the other side's text after its leading newlines, as a list of at most one edit. None if
+        # the two sides differed before this edit, or if it would have to land in leading newlines the other side
+        # doesn't have.
+        if op == 'insert':
+            before = span[:rel] + span[rel + len(text):]
+        else:
+            before = span[:rel] + text + span[rel:]
+        lead = self.lead(before)
+        other = self.bk.slice(otherDoc, otherStart, otherEnd)
+        otherLead = self.lead(other)
+        if not before[lead:] == other[otherLead:]:
+            return None
+        at = otherStart + otherLead + rel - lead
+        if at < otherStart:
+            # Only fine if all it did was add or remove leading newlines, the rest still matches
+            if op == 'insert' and text.strip('\n') == '' or op == 'delete' and rel + len(text) <= lead:
+                return []
+            return None
+        if op == 'insert':
+            return [(otherDoc, at, at, text)]
+        return [(otherDoc, at, at + len(text), '')]
+
+    def check(self, edits, source, target, n):
+        # Report a pair that no longer matches the first time it's seen
+        key = (source, target, n)
+        if edits is not None:
+            self.mismatched.discard(key)
+            return edits
+        if key not in self.mismatched:
+            self.mismatched.add(key)
+            print("Not syncing link", n + 1, "of", source, "with", target + ": their text differs")
+        return []
+
+    def forward(self, doc, op, offset, text, length):
+        # Edit inside the text of a passage -> its target segments
+        links = self.bk.links[doc]
+        i = links.firstAtOrAfter(offset + length)
+        if i >= len(links) or not links.kinds[i] == links.closer:
+            return []
+        n = links.closersBefore(i)
+        passage = self.passage(doc, n)
+        if passage is None or passage[1] >= offset:
+            return []
+        (opener, sep, close) = passage
+        span = self.bk.slice(doc, sep + 1, close)
+        edits = []
+        for target in self.targetsOf(doc, passage):
+            if target == doc or target not in self.bk.docTree:
+                continue
+            found = self.bk.links[target].segmentRange(n, self.bk.docLength(target))
+            if found is None:
+                continue
+            (start, end, closed) = found
+            edits += self.check(self.mirror(op, span, offset - sep - 1, target, start, end, text), doc, target, n)
+        return edits
+
+    def reverse(self, doc, op, offset, text, length):
+        # Edit inside a segment of a target -> the passage in each source document that points at it
+        links = self.bk.links[doc]
+        n = links.closersBefore(links.firstAtOrAfter(offset))
+        found = links.segmentRange(n, self.bk.docLength(doc))
+        if found is None:
+            return []
+        (start, end, closed) = found
+        span = None
+        edits = []
+        for source in self.bk.docTree:
+            if source == doc:
+                continue
+            passage = self.passage(source, n)
+            if passage is None or doc not in self.targetsOf(source, passage):
+                continue
+            (opener, sep, close) = passage
+            if span is None:
+                span = self.bk.slice(doc, start, end)
+            edits += self.check(self.mirror(op, span, offset - start, source, sep + 1, close, text), source, doc, n)
+        return edits
+
+
+class TelemetrySink:
+    # Buffers raw telemetry records in memory and appends them to disk in batches from a background thread,
+    # either every `flushInterval` seconds or as soon as `maxBuffered` records are waiting.
+    # Other telemetry writes are handed to the same thread with call(), so the Tk thread never waits on the disk.
+
+    flushInterval = 2.0
+    maxBuffered = 512
+
+    def __init__(self, path):
+        self.path = path
+        self.buffer = []
+        # Functions to run after the next batch is written
+        self.tasks = []
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = False
+        self.closed = False
+        self.worker = threading.Thread(target=self.run, name='TelemetrySink', daemon=True)
+        self.worker.start()
+        # Backstop in case the app exits without going through WritingSession.close
+        atexit.register(self.close)
+
+    def write(self, record):
+        with self.lock:
+            self.buffer.append(record)
+            full = len(self.buffer) >= self.maxBuffered
+        if full:
+            self.wake.set()
+
+    def call(self, fn):
+        # Run fn on the writer thread with the next batch, once however often it's asked for before then
+        with self.lock:
+            if fn not in self.tasks:
+                self.tasks.append(fn)
+
+    def run(self):
+        while not self.stopping:
+            self.wake.wait(self.flushInterval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            records = self.buffer
+            self.buffer = []
+            tasks = self.tasks
+            self.tasks = []
+        if records:
+            try:
+                with open(self.path, 'a+') as rawSesTmFile:
+                    rawSesTmFile.write(''.join(records))
+            except OSError as e:
+                print("Failed to write telemetry", e)
+                with self.lock:
+                    self.buffer = records + self.buffer
+        for fn in tasks:
+            try:
+                fn()
+            except Exception:
+                traceback.print_exc()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.stopping = True
+        self.wake.set()
+        self.worker.join()
+        self.flush()
+
+
+class TelemetryStore:
+    # Columnar telemetry samples with a fixed memory footprint.
+    # The live window is a preallocated NumPy array per column. When it fills up, the oldest `liveCapacity` samples are
+    # appended to raw binary segment files (one per column) and the newest half is moved to the front, so the live
+    # window is always one contiguous slice and RSS stays at 2 * liveCapacity samples.
+    # Spilled history is read back with np.memmap.
+
+    liveCapacity = 1 << 16
+    columns = (('times', 'f8'), ('chars', 'i8'), ('words', 'i8'))
+
+    def __init__(self, path, name):
+        loadNumpy()
+        self.path = path
+        self.name = name
+        self.bufs = {}
+        for (col, dtype) in self.columns:
+            self.bufs[col] = np.zeros(2 * self.liveCapacity, dtype=dtype)
+        self.end = 0
+        self.spilled = 0
+        self.historyCache = None
+
+    def __len__(self):
+        return self.spilled + self.end
+
+    def append(self, t, chars, words):
+        if self.end == 2 * self.liveCapacity:
+            self.spill()
+        self.bufs['times'][self.end] = t
+        self.bufs['chars'][self.end] = chars
+        self.bufs['words'][self.end] = words
+        self.end += 1
+
+    def segmentPath(self, col):
+        return os.path.join(self.path, self.name + '.' + col)
+
+    def spill(self):
+        cap = self.liveCapacity
+        os.makedirs(self.path, exist_ok=True)
+        for (col, dtype) in self.columns:
+            buf = self.bufs[col]
+            with open(self.segmentPath(col), 'ab') as seg:
+                buf[:cap].tofile(seg)
+            buf[:cap] = buf[cap:]
+        self.end = cap
+        self.spilled += cap
+        self.historyCache = None
+
+    def live(self, col):
+        # View into the live window, no copy
+        return self.bufs[col][:self.end]
+
+    def read(self, col, start, stop):
+        # Samples [start, stop) by global index. Only copies when the range straddles the spilled history.
+        if start >= self.spilled:
+            return self.live(col)[start - self.spilled:stop - self.spilled]
+        history = self.history(col)[start:min(stop, self.spilled)]
+        return np.concatenate((history, self.live(col)[:max(0, stop - self.spilled)]))
+
+    def history(self, col):
+        # Memory-mapped view of everything spilled to disk so far
+        if self.historyCache is None:
+            self.historyCache = {}
+            for (c, dtype) in self.columns:
+                if self.spilled == 0:
+                    self.historyCache[c] = np.zeros(0, dtype=dtype)
+                else:
+                    self.historyCache[c] = np.memmap(self.segmentPath(c), dtype=dtype, mode='r', shape=(self.spilled,))
+        return self.historyCache[col]
+
+
+class WpmSeries:
+    # Incrementally maintained words-per-minute series for the live plot.
+    # Samples are only stored when the counts change, so they're unevenly spaced and a pause shows up as one long gap.
+    # Averaging per-sample rates would count that gap as a single slow sample, so the rate is taken over windows of w
+    # samples from the cumulative counts instead:
+    #   (chars[j+w] - chars[j]) * 60 / 5 / (t[j+w] - t[j])
+    # which weighs every stretch by the time it covers. extend() only copies the new samples and drawing only
+    # evaluates the points that get plotted.
+
+    N = 1000
+    maxPoints = 2000
+
+    def __init__(self, capacity=TelemetryStore.liveCapacity):
+        loadNumpy()
+        self.capacity = 2 * capacity
+        self.t = np.zeros(self.capacity)
+        self.chars = np.zeros(self.capacity)
+        self.count = 0
+        self.consumed = 0
+        self.first = None
+        self.last = None
+
+    def extend(self, store):
+        stop = len(store)
+        if stop <= self.consumed:
+            return
+        times = store.read('times', self.consumed, stop)
+        chars = store.read('chars', self.consumed, stop)
+        self.consumed = stop
+        if self.first is None:
+            self.first = (times[0], chars[0])
+        self.last = (times[-1], chars[-1])
+
+        # Bounded like the store: keep the newest half when the window would overflow
+        half = self.capacity // 2
+        if len(times) > half:
+            times = times[-half:]
+            chars = chars[-half:]
+            self.count = 0
+        elif self.count + len(times) > self.capacity:
+            self.shift(self.count + len(times) - half)
+
+        n = self.count
+        k = len(times)
+        self.t[n:n + k] = times
+        self.chars[n:n + k] = chars
+        self.count = n + k
+
+    def shift(self, s):
+        n = self.count
+        self.t[:n - s] = self.t[s:n]
+        self.chars[:n - s] = self.chars[s:n]
+        self.count = n - s
+
+    def smoothed(self):
+        # (times, windowed WPM) at no more than maxPoints evenly spaced points, each plotted at the end of its window.
+        # With fewer than 2N samples the window shrinks so there is always something to plot.
+        if self.count < 2:
+            return (np.zeros(0), np.zeros(0))
+        w = min(self.N, self.count // 2)
+        points = self.count - w
+        j = np.unique(np.linspace(0, points - 1, min(points, self.maxPoints)).astype(np.int64))
+        dt = self.t[j + w] - self.t[j]
+        rate = np.divide((self.chars[j + w] - self.chars[j]) * 60 / 5, dt, out=np.zeros(len(j)), where=dt > 0)
+        return (self.t[j + w], rate)
+
+    def mean(self):
+        # Over the whole session, pauses included
+        if self.first is None or self.last[0] <= self.first[0]:
+            return 0.0
+        return float((self.last[1] - self.first[1]) * 60 / 5 / (self.last[0] - self.first[0]))
+
+
+class LivePlot:
+    # Live WPM chart in the Analysis tab.
+    # The two lines are persistent animated artists whose data is replaced in place. A frame only blits them over
+    # a cached background; a full redraw (draw_idle) happens only when the axes limits have to grow. Nothing is drawn
+    # while the Analysis tab is hidden, and frames are throttled to maxFps.
+
+    maxFps = 10
+
+    def __init__(self, ax, canvas, maxFps=None):
+        self.ax = ax
+        self.canvas = canvas
+        if maxFps is not None:
+            self.maxFps = maxFps
+        self.visible = False
+        self.lastFrame = 0
+        self.background = None
+        (self.runLine,) = ax.plot([], [], animated=True)
+        (self.meanLine,) = ax.plot([], [], animated=True)
+        ax.set_ylim([0,120])
+        self.canvas.mpl_connect('draw_event', self.onDraw)
+
+    def setVisible(self, visible):
+        becameVisible = visible and not self.visible
+        self.visible = visible
+        if becameVisible:
+            self.lastFrame = 0
+            self.canvas.draw_idle()
+
+    def wantsFrame(self):
+        return self.visible and time.time() - self.lastFrame >= 1.0 / self.maxFps
+
+    def onDraw(self, event):
+        # A full draw just happened (resize, limits changed, tab shown): re-cache the background without the lines
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.drawLines()
+
+    def drawLines(self):
+        self.ax.draw_artist(self.runLine)
+        self.ax.draw_artist(self.meanLine)
+        self.canvas.blit(self.ax.bbox)
+
+    def update(self, times, runMean, mean):
+        self.lastFrame = time.time()
+        self.runLine.set_data(times, runMean)
+        self.meanLine.set_data([times[0], times[-1]], [mean, mean])
+
+        (xmin, xmax) = self.ax.get_xlim()
+        if times[0] < xmin or times[-1] > xmax:
+            # Leave headroom so the next few seconds of samples still fit and can be blitted
+            span = max(times[-1] - times[0], 1.0)
+            self.ax.set_xlim([times[0], times[-1] + 0.25 * span])
+            self.background = None
+        if self.background is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self.drawLines()
+
+
+class TelemetryRollup:
+    # Minute, hour, day and week totals of the telemetry samples, so year-scale charts read a few thousand rows instead
+    # of re-parsing the raw stream. Each level is a file of fixed-size records sorted by bucket, so a time range is a
+    # binary search and a slice (read()). Samples are folded in as they arrive. Only the newest row of each level is
+    # still open; flush() appends the rows that closed since the last flush and rewrites the open one in place.
+    # Per bucket: net words added, chars typed, active seconds (gaps between samples up to idleGap) and sessions
+    # started. Buckets follow local time, and weeks start on Monday.
+    # add() runs on the Tk thread and flush() on TelemetrySink's writer thread. lock covers the rows in memory and
+    # ioLock the files, so add() only ever waits for the bookkeeping at either end of a flush.
+
+    levels = (('minute', 60), ('hour', 3600), ('day', 86400), ('week', 604800))
+    fields = (('bucket', 'i8'), ('words', 'i8'), ('chars', 'i8'), ('active', 'f8'), ('sessions', 'i8'))
+    # A longer gap between samples is a break, not writing time
+    idleGap = 30.0
+
+    def __init__(self, path):
+        loadNumpy()
+        self.path = path
+        self.dtype = np.dtype(list(self.fields))
+        self.lock = threading.Lock()
+        self.ioLock = threading.Lock()
+        # level -> open row as [bucket, words, chars, active, sessions], the rows closed since the last flush, and
+        # whether the file's last record is the first of those rows (so flush() overwrites it)
+        self.open = {}
+        self.closed = {}
+        self.tailStored = {}
+        for (level, width) in self.levels:
+            self.closed[level] = []
+            last = self.lastStored(level)
+            self.open[level] = None if last is None else [x.item() for x in last]
+            self.tailStored[level] = last is not None
+        self.lastSample = None
+
+    def levelPath(self, level):
+        return os.path.join(self.path, 'rollup-%s.bin' % level)
+
+    def lastStored(self, level):
+        # Last whole record of a level's file, None if there isn't one
+        try:
+            with open(self.levelPath(level), 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                records = f.tell() // self.dtype.itemsize
+                if records == 0:
+                    return None
+                f.seek((records - 1) * self.dtype.itemsize)
+                return np.frombuffer(f.read(self.dtype.itemsize), dtype=self.dtype)[0]
+        except OSError:
+            return None
+
+    def bucketOf(self, t, width):
+        local = t + time.localtime(t).tm_gmtoff
+        if width == 604800:
+            # The epoch was a Thursday
+            local += 3 * 86400
+        return int(local // width)
+
+    def startSession(self):
+        # The next sample starts a new session: no deltas or active time from the previous sample
+        self.lastSample = None
+
+    def add(self, t, chars, words):
+        # Fold in a sample of the running totals. True if a minute closed, i.e. there is something worth flushing.
+        with self.lock:
+            if self.lastSample is None:
+                (dWords, dChars, active, sessions) = (0, 0, 0.0, 1)
+            else:
+                (lastT, lastChars, lastWords) = self.lastSample
+                gap = t - lastT
+                (dWords, dChars, active, sessions) = (words - lastWords, max(chars - lastChars, 0),
+                                                      gap if 0 < gap <= self.idleGap else 0.0, 0)
+            self.lastSample = (t, chars, words)
+            closed = False
+            for (level, width) in self.levels:
+                bucket = self.bucketOf(t, width)
+                row = self.open[level]
+                # A sample from before the open bucket (the clock went back) is counted in it, rows stay sorted
+                if row is None or bucket > row[0]:
+                    if row is not None:
+                        self.closed[level].append(row)
+                        closed = True
+                    row = self.open[level] = [bucket, 0, 0, 0.0, 0]
+                row[1] += dWords
+                row[2] += dChars
+                row[3] += active
+                row[4] += sessions
+            return closed
+
+    def flush(self):
+        with self.ioLock:
+            os.makedirs(self.path, exist_ok=True)
+            for (level, width) in self.levels:
+                # The rows as they are now; add() carries on with the open row while they're written
+                with self.lock:
+                    closed = len(self.closed[level])
+                    hasOpen = self.open[level] is not None
+                    rows = [tuple(row) for row in self.closed[level] + ([self.open[level]] if hasOpen else [])]
+                if not rows:
+                    continue
+                path = self.levelPath(level)
+                try:
+                    with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+                        f.seek(0, os.SEEK_END)
+                        # Drop a torn record left by a crash
+                        end = f.tell() // self.dtype.itemsize * self.dtype.itemsize
+                        if self.tailStored[level]:
+                            end -= self.dtype.itemsize
+                        f.seek(max(end, 0))
+                        f.write(np.array(rows, dtype=self.dtype).tobytes())
+                        f.truncate()
+                except OSError as e:
+                    print("Failed to write telemetry rollup", e)
+                    continue
+                # If the open row closed meanwhile it's now the first closed row, and still the file's last record
+                with self.lock:
+                    del self.closed[level][:closed]
+                    self.tailStored[level] = hasOpen
+
+    def read(self, level, start=None, stop=None):
+        # Rows of a level with bucket start times in [start, stop) (epoch seconds, None for open-ended), including
+        # what hasn't been flushed yet
+        with self.ioLock:
+            try:
+                stored = np.fromfile(self.levelPath(level), dtype=self.dtype)
+            except (OSError, ValueError):
+                stored = np.zeros(0, dtype=self.dtype)
+            if self.tailStored[level] and len(stored):
+                stored = stored[:-1]
+            with self.lock:
+                pending = [tuple(row) for row in
+                           self.closed[level] + ([self.open[level]] if self.open[level] is not None else [])]
+        rows = np.concatenate((stored, np.array(pending, dtype=self.dtype)))
+        width = dict(self.levels)[level]
+        lo = 0 if start is None else np.searchsorted(rows['bucket'], self.bucketOf(start, width))
+        hi = len(rows) if stop is None else np.searchsorted(rows['bucket'], self.bucketOf(stop, width))
+        return rows[lo:hi]
+
+    def bucketStart(self, level, bucket):
+        # Epoch seconds a bucket starts at, the inverse of bucketOf() up to a change of UTC offset
+        width = dict(self.levels)[level]
+        local = bucket * width - (3 * 86400 if width == 604800 else 0)
+        return local - time.localtime(local).tm_gmtoff
+
+    def rebuild(self, csvPath):
+        # Recompute every level from the raw stream. Each line of the file is one session of 't,chars,words;' records.
+        for (level, width) in self.levels:
+            self.open[level] = None
+            self.closed[level] = []
+            self.tailStored[level] = False
+            if os.path.exists(self.levelPath(level)):
+                os.remove(self.levelPath(level))
+        with open(csvPath, 'r') as f:
+            for line in f:
+                self.startSession()
+                for record in line.split(';'):
+                    parts = record.split(',')
+                    if not len(parts) == 3:
+                        continue
+                    try:
+                        self.add(float(parts[0]), int(parts[1]), int(parts[2]))
+                    except ValueError:
+                        continue
+        self.flush()
 
 
 class Telemetry:
     tmPath = "telem"
-    words = []
-    times = []
+    rawPath = 'rawSessionTm.csv'
+
+    sink = None
+    store = None
+    wpm = None
+    lastCounts = None
 
     def __init__(self,book):
         self.bk = book
-        with open('rawSessionTm.csv', 'a+') as rawSesTmFile:
-            rawSesTmFile.write('\n')
+        self.sink = TelemetrySink(self.rawPath)
+        self.sink.write('\n')
+        self.store = TelemetryStore(self.tmPath, 'session-%d' % int(time.time()))
+        self.wpm = WpmSeries()
+        self.rollup = TelemetryRollup(self.tmPath)
+
+    # Live window of the session as contiguous arrays. words holds the char count, plot() turns it into words with /5
+    @property
+    def words(self):
+        return self.store.live('chars')
+
+    @property
+    def times(self):
+        return self.store.live('times')
 
     def update(self):
-        totalWords = self.bk.getTotalWordsExpensive()
+        totalWords = self.bk.getTotalWords()
+        # Idle time is implied by the gap between samples, don't record the same counts again
+        if totalWords == self.lastCounts:
+            return
+        self.lastCounts = totalWords
         t = time.time()
-        with open('rawSessionTm.csv','a+') as rawSesTmFile:
-            rawSesTmFile.write(str(t) + ',' + str(totalWords[0]) + ',' + str(totalWords[1]) + ';')
-        self.words.append(totalWords[0])
-        self.times.append(t)
-
-    def plot(self,plot,canvas):
-        if(len(self.words) < 1000):
-
-            return
-        deltaTimes = []
-        deltaWords = []
-        wpts = []
-        for ids in range(len(self.times) - 1):
-            deltaTimes.append(self.times[ids + 1] - self.times[ids])
-            deltaWords.append(self.words[ids + 1] - self.words[ids])
-            wpts.append(deltaWords[ids] / deltaTimes[ids] * 60 / 5)
-
-        N = 1000
-        runMean = np.convolve(wpts, np.ones(N) / N, mode='valid')
-        runMean = np.convolve(runMean, np.ones(N) / N, mode='valid')
-        plot.cla()
-        plot.plot(self.times[:len(runMean)], runMean)
-        mdwords = np.average(wpts)
-        plot.plot(self.times[:len(runMean)], [mdwords]*len(self.times[:len(runMean)]))
-        ax = plt.gca()
-        ax.set_ylim([0,120])
-        canvas.draw()
+        self.sink.write(str(t) + ',' + str(totalWords[0]) + ',' + str(totalWords[1]) + ';')
+        self.store.append(t, totalWords[0], totalWords[1])
+        if self.rollup.add(t, totalWords[0], totalWords[1]):
+            self.sink.call(self.rollup.flush)
+
+    def close(self):
+        self.sink.call(self.rollup.flush)
+        self.sink.close()
+
+    @timed('Telemetry.plot')
+    def plot(self,livePlot):
+        if livePlot is None or not livePlot.wantsFrame():
+            return
+        self.wpm.extend(self.store)
+        (times, runMean) = self.wpm.smoothed()
+        if len(times) == 0:
+            return
+        livePlot.update(times, runMean, self.wpm.mean())
         #plt.show(block=False)
 
 
 
+class ScheduledJob:
+    def __init__(self, name, fn, interval, priority, idleInterval):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.priority = priority
+        self.idleInterval = idleInterval
+        self.due = 0
+
+
+class Scheduler:
+    # Runs periodic jobs from the Tk event loop with root.after, so the app sleeps between jobs instead of spinning.
+    # Jobs that are due together run highest priority first. Once a tick has used up frameBudget the rest wait for
+    # the next tick, which gives Tk a chance to handle input in between.
+    # After idleAfter seconds without input every job switches to its idleInterval; poke() switches them back.
+    # A job without one backs off to idleBackoff times its interval. A job whose function returns True has nothing
+    # left to do and waits its idleInterval even while the user is active.
+
+    frameBudget = 0.02
+    idleAfter = 2.0
+    idleBackoff = 5
+
+    def __init__(self, root):
+        self.root = root
+        self.jobs = []
+        self.lastActivity = time.time()
+        self.afterId = None
+        self.running = False
+
+    def addJob(self, name, fn, interval, priority=0, idleInterval=None):
+        if idleInterval is None:
+            idleInterval = interval * self.idleBackoff
+        job = ScheduledJob(name, fn, interval, priority, idleInterval)
+        job.due = time.time() + interval
+        self.jobs.append(job)
+        self.jobs.sort(key=lambda j: -j.priority)
+        if self.running:
+            self.reschedule()
+        return job
+
+    def removeJob(self, name):
+        self.jobs = [job for job in self.jobs if not job.name == name]
+
+    def isIdle(self, now=None):
+        if now is None:
+            now = time.time()
+        return now - self.lastActivity >= self.idleAfter
+
+    def poke(self):
+        # Input happened. If we were backed off, pull every job's next run in to its active interval.
+        now = time.time()
+        wasIdle = self.isIdle(now)
+        self.lastActivity = now
+        if wasIdle:
+            for job in self.jobs:
+                job.due = min(job.due, now + job.interval)
+            self.reschedule()
+
+    def start(self):
+        self.running = True
+        self.reschedule()
+
+    def stop(self):
+        self.running = False
+        if self.afterId is not None:
+            self.root.after_cancel(self.afterId)
+            self.afterId = None
+
+    def reschedule(self):
+        if not self.running:
+            return
+        if self.afterId is not None:
+            self.root.after_cancel(self.afterId)
+        if len(self.jobs) == 0:
+            self.afterId = None
+            return
+        delay = min(job.due for job in self.jobs) - time.time()
+        self.afterId = self.root.after(max(1, math.ceil(delay * 1000)), self.tick)
+
+    def tick(self):
+        self.afterId = None
+        start = time.time()
+        idle = self.isIdle(start)
+        for job in self.jobs:
+            now = time.time()
+            if now - start >= self.frameBudget:
+                break
+            if job.due > now:
+                continue
+            latency.record('tk.lateness', now - job.due)
+            began = time.perf_counter()
+            done = False
+            try:
+                done = job.fn() is True
+            except Exception:
+                traceback.print_exc()
+            latency.record('job.' + job.name, time.perf_counter() - began)
+            job.due = time.time() + (job.idleInterval if idle or done else job.interval)
+        self.reschedule()
+
+
 class WritingSession:
 
     startTime = 0
     currentTime = 0
-    prevSaveTime = 0
     saveInterval = 1.0 # 5 seconds
     tmInterval = 0.01 # 1 second
+    tmIdleInterval = 1.0
+    plotIdleInterval = 1.0
+    loadInterval = 0.05
+    # The search index is brought up to date in slices of searchBudget seconds while sections are stale, and only
+    # checked every searchIdleInterval once it's current
+    searchInterval = 0.25
+    searchIdleInterval = 5.0
+    searchBudget = 0.02
 
     bk = None
     tm = None
 
     activeIdx = ('',0,0)
 
-    def __init__(self):
+    def __init__(self, docNames=None, profile=None):
+        # Only docNames (the documents the panes open with) are parsed before the editor comes up. The rest are
+        # parsed in the background, and telemetry and the file watcher start once the whole book is in, so the
+        # word counts they see don't jump as documents arrive.
         self.startTime = time.time()
         self.currentTime = time.time()
-        self.prevSaveTime = self.currentTime
-        self.prevTmTime = self.currentTime
-        self.bk = Book()
-        self.tm = Telemetry(self.bk)
+        self.profile = profile
+        self.bk = Book(docNames)
+        self.tm = None
+        self.watcher = DocWatcher(self.bk)
+        self.readability = ReadabilityTracker(self.bk)
+        self.scheduler = None
+        self.bk.loadInBackground()
 
         self.plot1 = None
         self.canvas = None
+        self.livePlot = None
+
+    def schedule(self, scheduler):
+        # Telemetry sampling first so samples keep their timestamps, then saving, plotting last.
+        # The debouncer in DocSaver decides when to write; the save job backs off no further than its maxDelay.
+        self.scheduler = scheduler
+        scheduler.addJob('load', self.finishLoading, self.loadInterval, priority=3)
+        scheduler.addJob('telemetry', self.updateTelemetry, self.tmInterval, priority=2, idleInterval=self.tmIdleInterval)
+        scheduler.addJob('save', self.bk.saver.update, self.saveInterval, priority=1, idleInterval=DocSaver.maxDelay)
+        # Throttled by the LivePlot itself, and a no-op while the Analysis tab is hidden
+        scheduler.addJob('plot', self.updatePlot, 1.0 / LivePlot.maxFps, priority=0, idleInterval=self.plotIdleInterval)
+        scheduler.addJob('search', self.updateSearch, self.searchInterval, priority=0, idleInterval=self.searchIdleInterval)
+
+    def finishLoading(self):
+        if not self.bk.installLoaded():
+            return
+        self.scheduler.removeJob('load')
+        self.bk.printTotals()
+        self.tm = Telemetry(self.bk)
+        self.watcher.start()
+        if self.profile is not None:
+            self.profile.mark('all documents parsed, telemetry started')
+            self.profile.report()
 
-    def update(self):
-        self.currentTime = time.time() - self.startTime
-
-        # Poll User Inputs
-
-        # Update book with inputs
-
+    def updateTelemetry(self):
+        if self.tm is not None:
+            self.tm.update()
 
-        if(abs(self.prevSaveTime - self.currentTime) >= self.saveInterval):
-            self.prevSaveTime = self.currentTime
-            self.bk.saveAll()
-            self.tm.plot(self.plot1,self.canvas)
+    def updatePlot(self):
+        self.currentTime = time.time() - self.startTime
+        if self.tm is not None:
+            self.tm.plot(self.livePlot)
 
-        if(abs(self.prevTmTime - self.currentTime) >= self.tmInterval):
-            self.prevTmTime = self.currentTime
-            self.tm.update()
+    def updateSearch(self):
+        # True once nothing is stale, which backs the job off
+        return self.bk.search.refresh(self.searchBudget)
 
     def setPlotCanv(self,plot,can):
         self.plot1 = plot
         self.canvas = can
+        self.livePlot = LivePlot(plot, can)
+
+    def close(self):
+        self.watcher.stop()
+        # Flushes the dirty documents only. Rewriting everything would also put stale text back over files changed
+        # on disk that the watcher hasn't applied yet.
+        self.bk.saver.stop()
+        self.bk.search.save()
+        self.readability.close()
+        if self.tm is not None:
+            self.tm.close()
+
+
+class StartupProfile:
+    # --profile-startup: wall-clock time between startup milestones, and a cProfile of everything up to the first
+    # report (the editor being usable). The second report, once the background parsing is done, only adds milestones.
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.start = time.perf_counter()
+        self.marks = []
+        self.reported = 0
+        self.profiler = None
+        if enabled:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def mark(self, milestone):
+        if self.enabled:
+            self.marks.append((milestone, time.perf_counter()))
+
+    def report(self):
+        if not self.enabled:
+            return
+        if self.profiler is not None:
+            self.profiler.disable()
+        print('Startup profile (step, since launch):')
+        prev = self.marks[self.reported - 1][1] if self.reported else self.start
+        for (milestone, t) in self.marks[self.reported:]:
+            print('  %8.1f ms  %8.1f ms  %s' % ((t - prev) * 1000, (t - self.start) * 1000, milestone))
+            prev = t
+        self.reported = len(self.marks)
+        if self.profiler is not None:
+            import pstats
+            pstats.Stats(self.profiler).sort_stats('cumulative').print_stats(30)
+            self.profiler = None
+
+class MarkupIndex:
+    # Offsets of one kind of markup delimiter (e.g. '<', '@', '>') in a widget's text, kept current from edit deltas.
+    # The offsets are stored as the gaps between consecutive delimiters in a Fenwick tree. An edit that doesn't add or
+    # remove a delimiter only changes the gap of the next delimiter, O(log n), and any delimiter's offset is a prefix
+    # sum, also O(log n). Edits that do add or remove delimiters rebuild the tree, which is O(delimiters), not O(text).
+
+    def __init__(self, opener, separator, closer):
+        self.opener = opener
+        self.separator = separator
+        self.closer = closer
+        self.pattern = re.compile('[' + re.escape(opener + separator + closer) + ']')
+        self.build([], [])
+
+    def rebuild(self, text, base=0):
+        # base is the offset text starts at, for an index over part of a document
+        matches = list(self.pattern.finditer(text))
+        self.build([base + m.start() for m in matches], [m.group() for m in matches])
+
+    def build(self, positions, kinds):
+        self.kinds = kinds
+        size = len(positions)
+        self.gaps = [0] * (size + 1)
+        self.closers = [0] * (size + 1)
+        prev = 0
+        for i in range(1, size + 1):
+            self.gaps[i] += positions[i - 1] - prev
+            self.closers[i] += 1 if kinds[i - 1] == self.closer else 0
+            prev = positions[i - 1]
+            j = i + (i & -i)
+            if j <= size:
+                self.gaps[j] += self.gaps[i]
+                self.closers[j] += self.closers[i]
+        self.top = 1 << size.bit_length()
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def prefix(self, tree, i):
+        total = 0
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def position(self, i):
+        return self.prefix(self.gaps, i + 1)
+
+    def positions(self):
+        return [self.position(i) for i in range(len(self.kinds))]
+
+    def closersBefore(self, i):
+        # How many closers come before delimiter i
+        return self.prefix(self.closers, i)
+
+    def closerCount(self):
+        return self.prefix(self.closers, len(self.kinds))
+
+    def nthCloser(self, n):
+        # Index of the n-th (0-based) closer, O(log n)
+        idx = 0
+        rem = n + 1
+        step = self.top
+        while step:
+            j = idx + step
+            if j <= len(self.kinds) and self.closers[j] < rem:
+                idx = j
+                rem -= self.closers[j]
+            step >>= 1
+        return idx
+
+    def segmentRange(self, n, length):
+        # Offsets [start, end) of the n-th closer-delimited segment of a text of the given length, and whether that
+        # segment is already terminated by a closer. The book keeps one linked passage per ']'-terminated segment.
+        closers = self.closerCount()
+        if n > closers:
+            return None
+        start = 0 if n == 0 else self.position(self.nthCloser(n - 1)) + 1
+        if n < closers:
+            return (start, self.position(self.nthCloser(n)), True)
+        return (start, length, False)
+
+    def firstAtOrAfter(self, pos):
+        # Index of the first delimiter at an offset >= pos, len(self) if there is none
+        idx = 0
+        rem = pos
+        step = self.top
+        while step:
+            j = idx + step
+            if j <= len(self.kinds) and self.gaps[j] < rem:
+                idx = j
+                rem -= self.gaps[j]
+            step >>= 1
+        return idx
+
+    def shift(self, i, delta):
+        i += 1
+        while i < len(self.gaps):
+            self.gaps[i] += delta
+            i += i & -i
+
+    def onInsert(self, offset, text):
+        i = self.firstAtOrAfter(offset)
+        if self.pattern.search(text) is None:
+            if i < len(self.kinds):
+                self.shift(i, len(text))
+            return
+        positions = self.positions()
+        kinds = self.kinds
+        added = [(offset + m.start(), m.group()) for m in self.pattern.finditer(text)]
+        after = [(p + len(text), k) for (p, k) in zip(positions[i:], kinds[i:])]
+        merged = list(zip(positions[:i], kinds[:i])) + added + after
+        self.build([p for (p, k) in merged], [k for (p, k) in merged])
+
+    def onDelete(self, offset, removed):
+        i = self.firstAtOrAfter(offset)
+        j = self.firstAtOrAfter(offset + len(removed))
+        if i == j:
+            if i < len(self.kinds):
+                self.shift(i, -len(removed))
+            return
+        positions = self.positions()
+        kinds = self.kinds
+        kept = list(zip(positions[:i], kinds[:i])) + [(p - len(removed), k) for (p, k) in zip(positions[j:], kinds[j:])]
+        self.build([p for (p, k) in kept], [k for (p, k) in kept])
+
+    def findOpener(self, pos):
+        # For markup closed at pos (or a cursor at pos), walk back to the nearest unclosed opener.
+        # Returns (opener offset, first separator offset after it or None), or None if a closer comes first.
+        sep = None
+        i = self.firstAtOrAfter(pos) - 1
+        while i >= 0:
+            kind = self.kinds[i]
+            if kind == self.separator:
+                sep = self.position(i)
+            elif kind == self.opener:
+                return (self.position(i), sep)
+            else:
+                return None
+            i -= 1
+        return None
+
+
+class TermMatcher:
+    # Aho-Corasick automaton over a set of terms: one pass over a text finds every occurrence of all of them, however
+    # many there are. Matches are case-sensitive and whole-word, and overlapping ones resolve to the leftmost, then
+    # the longest.
+
+    def __init__(self, terms):
+        self.goto = [{}]
+        self.fail = [0]
+        # Lengths of the terms ending at each state, its own and those reached through its fail links
+        self.out = [()]
+        for term in terms:
+            if term:
+                self.addTerm(term)
+        self.link()
+
+    def addTerm(self, term):
+        state = 0
+        for ch in term:
+            nxt = self.goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(())
+            state = nxt
+        if len(term) not in self.out[state]:
+            self.out[state] += (len(term),)
+
+    def link(self):
+        # Breadth first, so a state's fail target is always finished before the state itself
+        pending = collections.deque(self.goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for (ch, nxt) in self.goto[state].items():
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                target = self.goto[f].get(ch, 0)
+                self.fail[nxt] = target if not target == nxt else 0
+                self.out[nxt] += self.out[self.fail[nxt]]
+                pending.append(nxt)
+
+    def find(self, text):
+        # (start, end) of each match in text
+        found = []
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        state = 0
+        for (i, ch) in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                end = i + 1
+                if end < len(text) and (text[end].isalnum() or text[end] == '_'):
+                    continue
+                for length in out[state]:
+                    start = end - length
+                    if start == 0 or not (text[start - 1].isalnum() or text[start - 1] == '_'):
+                        found.append((start, end))
+        found.sort(key=lambda span: (span[0], -span[1]))
+        spans = []
+        for span in found:
+            if not spans or span[0] >= spans[-1][1]:
+                spans.append(span)
+        return spans
+
+
+class TermLinker:
+    # Proper nouns defined in the definition documents, linked wherever they're used. Every '##' heading in those
+    # documents defines its title as a term, and a comma-separated list in the heading defines aliases:
+    # '## Sally Smith, Sally' makes both names link to that section. The TermMatcher is rebuilt on a worker thread
+    # whenever the definition documents' headings change; the panes keep the old one until the new one is ready.
+
+    definitionDocs = ('characters', 'world')
+
+    def __init__(self, book):
+        self.bk = book
+        self.matcher = None
+        self.version = None
+        self.definitions = {}
+        self.built = queue.Queue()
+        self.builder = None
+
+    def headingVersion(self):
+        return tuple(self.bk.sectionVersion.get(docName) if docName in self.bk.docTree else None
+                     for docName in self.definitionDocs)
+
+    def collect(self):
+        # term -> (docName, heading title). Reads only the headings, O(sections).
+        definitions = {}
+        for docName in self.definitionDocs:
+            if docName not in self.bk.docTree:
+                continue
+            for section in range(len(self.bk.sections[docName])):
+                title = self.bk.sectionTitle(docName, section)
+                for term in title.split(','):
+                    term = term.strip()
+                    if term:
+                        definitions.setdefault(term, (docName, title))
+        return definitions
+
+    def update(self):
+        # Call from the UI thread. Returns the new matcher once a rebuild has finished, otherwise None.
+        try:
+            (version, definitions, matcher) = self.built.get_nowait()
+        except queue.Empty:
+            pass
+        else:
+            self.builder = None
+            self.definitions = definitions
+            self.matcher = matcher
+            return matcher
+        version = self.headingVersion()
+        if self.builder is None and not version == self.version:
+            self.version = version
+            definitions = self.collect()
+            self.builder = threading.Thread(target=self.build, args=(version, definitions), name='TermLinker',
+                                            daemon=True)
+            self.builder.start()
+        return None
+
+    def build(self, version, definitions):
+        self.built.put((version, definitions, TermMatcher(definitions)))
+
+    def termAt(self, line, col):
+        # The defined term covering column col of a line of text, None if there isn't one
+        if self.matcher is None:
+            return None
+        for (start, end) in self.matcher.find(line):
+            if start <= col < end:
+                return line[start:end]
+        return None
+
+    def definitionOf(self, term):
+        # (docName, section) defining term, None if it's gone since the matcher was built
+        if term not in self.definitions:
+            return None
+        (docName, title) = self.definitions[term]
+        if docName not in self.bk.docTree:
+            return None
+        for section in range(len(self.bk.sections[docName])):
+            if self.bk.sectionTitle(docName, section) == title:
+                return (docName, section)
+        return None
+
 
 class RichText(tk.Text):
+    # Once it shows a Book document (locator and docName set), the widget only holds the text between windowStart and
+    # windowEnd. Scrolling near either edge streams the next windowBlock characters in from the Book and tokenizes
+    # their markup, and the far edge is trimmed once the window passes maxWindow, so Tk never holds more than about
+    # maxWindow characters however long the manuscript is. Offsets passed to onEdit and offsetIndex are always
+    # offsets into the whole document.
+
+    windowBlock = 1 << 15
+    maxWindow = 1 << 18
+    # Keep at least this many lines loaded above and below the view
+    marginLines = 100
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         default_font = tkFont.nametofont(self.cget("font"))
@@ -297,10 +2851,345 @@ class RichText(tk.Text):
         self.tag_configure("H2", font=h2_font, spacing3=default_size)
         self.tag_configure("H3", font=h3_font, spacing3=default_size)
         self.tag_configure('hidden',elide=True)
+        self.tag_configure('term', underline=True)
 
         lmargin2 = em + default_font.measure("\u2022 ")
         self.tag_configure("bullet", lmargin1=em, lmargin2=lmargin2)
 
+        # Every insert/delete on the widget (typing, paste, undo/redo, programmatic) goes through the Tcl widget
+        # command, so rename it and route it through proxy() to report each change as a delta to onEdit.
+        self.docName = ''
+        self.locator = None
+        self.bookLinks = False
+        self.windowStart = 0
+        self.windowEnd = 0
+        self.streamPending = False
+        self.scrollCommand = None
+        self.onEdit = None
+        self.silent = 0
+        self.lastDeleted = ''
+        self.lastDeletedAt = -1
+        self.lastInserted = ''
+        self.lastInsertedAt = -1
+        self.tagIndex = MarkupIndex('<', '@', '>')
+        # Set to a TermMatcher to underline the defined terms. Edited lines are only re-tagged by retagTerms().
+        self.matcher = None
+        self.termsPending = False
+        self.origCmd = self._w + '_orig'
+        self.tk.call('rename', self._w, self.origCmd)
+        self.tk.createcommand(self._w, self.proxy)
+        self.configure(yscrollcommand=self.onYScroll)
+
+    def destroy(self):
+        self.tk.deletecommand(self._w)
+        self.tk.call('rename', self.origCmd, self._w)
+        super().destroy()
+
+    def hasLocator(self):
+        # The Book's line index matches this widget once the widget holds one of its documents
+        return self.locator is not None and self.docName in self.locator.docTree
+
+    def charOffset(self, index):
+        # Characters from 1.0 to index, with index clamped to the last real character the way insert/delete clamp it
+        index = self.tk.call(self.origCmd, 'index', index)
+        if self.tk.getboolean(self.tk.call(self.origCmd, 'compare', index, '>=', 'end')):
+            index = self.tk.call(self.origCmd, 'index', 'end-1c')
+        if self.hasLocator():
+            (line, col) = [int(n) for n in str(index).split('.')]
+            (startLine, startCol) = self.locator.indexOf(self.docName, self.windowStart)
+            if line == 1:
+                col += startCol
+            return self.locator.offsetOf(self.docName, startLine + line - 1, col)
+        count = self.tk.call(self.origCmd, 'count', '-chars', '1.0', index)
+        return int(count) if count != '' else 0
+
+    def proxy(self, cmd, *args):
+        if self.silent or cmd not in ('insert', 'delete', 'replace'):
+            return self.tk.call((self.origCmd, cmd) + args)
+
+        if cmd == 'insert':
+            offset = self.charOffset(args[0])
+            result = self.tk.call((self.origCmd, cmd) + args)
+            text = ''.join(args[1::2])
+            if text:
+                self.notify('insert', offset, text)
+            return result
+
+        if cmd == 'delete' and len(args) > 2:
+            # Several ranges at once, Tk sorts and merges them. Report the one span that covers them all.
+            old = self.tk.call(self.origCmd, 'get', '1.0', 'end-1c')
+            base = self.charOffset('1.0')
+            result = self.tk.call((self.origCmd, cmd) + args)
+            new = self.tk.call(self.origCmd, 'get', '1.0', 'end-1c')
+            span = diffSpan(old, new)
+            if span is not None:
+                (start, oldEnd, newEnd) = span
+                self.notify('delete', base + start, old[start:oldEnd])
+                if newEnd > start:
+                    self.notify('insert', base + start, new[start:newEnd])
+            return result
+
+        start = self.tk.call(self.origCmd, 'index', args[0])
+        if len(args) > 1:
+            end = self.tk.call(self.origCmd, 'index', args[1])
+        else:
+            end = self.tk.call(self.origCmd, 'index', start + '+1c')
+        if self.tk.getboolean(self.tk.call(self.origCmd, 'compare', end, '>=', 'end')):
+            end = self.tk.call(self.origCmd, 'index', 'end-1c')
+        offset = self.charOffset(start)
+        removed = ''
+        if self.tk.getboolean(self.tk.call(self.origCmd, 'compare', start, '<', end)):
+            removed = self.tk.call(self.origCmd, 'get', start, end)
+        result = self.tk.call((self.origCmd, cmd) + args)
+        if removed:
+            self.notify('delete', offset, removed)
+        if cmd == 'replace':
+            text = ''.join(args[2::2])
+            if text:
+                self.notify('insert', offset, text)
+        return result
+
+    def notify(self, op, offset, text):
+        if op == 'insert':
+            self.lastInserted = text
+            self.lastInsertedAt = offset
+            self.windowEnd += len(text)
+            self.tagIndex.onInsert(offset, text)
+        else:
+            self.lastDeleted = text
+            self.lastDeletedAt = offset
+            self.windowEnd -= len(text)
+            self.tagIndex.onDelete(offset, text)
+        if self.matcher is not None:
+            self.termsChanged(offset, len(text) if op == 'insert' else 0)
+        if self.onEdit is not None:
+            self.onEdit(self, op, offset, text)
+
+    def rebuildMarkup(self):
+        self.tagIndex.rebuild(self.get('1.0', 'end-1c'), self.windowStart)
+
+    def offsetIndex(self, offset):
+        if self.hasLocator():
+            if offset <= self.windowStart:
+                return '1.0'
+            if offset >= self.windowEnd:
+                return 'end-1c'
+            (line, col) = self.locator.indexOf(self.docName, offset)
+            (startLine, startCol) = self.locator.indexOf(self.docName, self.windowStart)
+            if line == startLine:
+                col -= startCol
+            return '%d.%d' % (line - startLine + 1, col)
+        return '1.0 + %dc' % offset
+
+    def covers(self, start, end):
+        # Whether document range [start, end) can be edited through the widget
+        return not self.hasLocator() or (self.windowStart <= start and end <= self.windowEnd)
+
+    def insertMarkup(self, index, text):
+        # Insert document text at index with its markup hidden and tagged. Goes straight to Tk, the caller decides
+        # whether it counts as an edit.
+        runs = []
+        for (run, tags) in tokenizeMarkup(text, self.bookLinks):
+            # Merge neighbouring runs with the same tags so Tk sees as few chunks as possible
+            if runs and runs[-1][1] == tags:
+                runs[-1] = (runs[-1][0] + run, tags)
+            else:
+                runs.append((run, tags))
+        # One Tk insert takes many (text, tags) pairs; batch them instead of one call per fragment. The batches go in
+        # at a right-gravity mark so each lands after the one before.
+        batch = 2048
+        self.mark_set('markupAt', index)
+        self.mark_gravity('markupAt', tk.RIGHT)
+        self.mark_set('markupFrom', index)
+        self.mark_gravity('markupFrom', tk.LEFT)
+        for start in range(0, len(runs), batch):
+            args = []
+            for (run, tags) in runs[start:start + batch]:
+                args.append(run)
+                args.append(tags)
+            self.insert('markupAt', *args)
+        self.tagTerms('markupFrom linestart', 'markupAt lineend')
+        self.mark_unset('markupAt', 'markupFrom')
+
+    def setMatcher(self, matcher):
+        self.matcher = matcher
+        self.termsPending = False
+        self.tagTerms('1.0', 'end')
+
+    def tagTerms(self, start, end):
+        # Re-tag the terms in [start, end), which should be whole lines. The hidden markup is scanned along with the
+        # text, so Tk's char counts line up with the match offsets.
+        self.tag_remove('term', start, end)
+        if self.matcher is None:
+            return
+        base = self.index(start)
+        args = []
+        for (s, e) in self.matcher.find(self.get(base, end)):
+            args.append('%s + %dc' % (base, s))
+            args.append('%s + %dc' % (base, e))
+        # One Tk call for many ranges
+        batch = 2048
+        for i in range(0, len(args), batch):
+            self.tag_add('term', *args[i:i + batch])
+
+    def termsChanged(self, offset, length):
+        # Widen the pending re-tag to the lines of [offset, offset + length). The range is kept as marks so later
+        # edits move it along.
+        # Called before the Book has the edit, so only offset itself maps through it; the end is counted in the widget
+        index = self.offsetIndex(offset)
+        start = index + ' linestart'
+        end = '%s + %dc lineend' % (index, length)
+        if not self.termsPending:
+            self.termsPending = True
+            self.mark_set('termsFrom', start)
+            self.mark_gravity('termsFrom', tk.LEFT)
+            self.mark_set('termsTo', end)
+            self.mark_gravity('termsTo', tk.RIGHT)
+            return
+        if self.compare(start, '<', 'termsFrom'):
+            self.mark_set('termsFrom', start)
+        if self.compare(end, '>', 'termsTo'):
+            self.mark_set('termsTo', end)
+
+    def retagTerms(self):
+        if not self.termsPending:
+            return
+        self.termsPending = False
+        self.tagTerms('termsFrom linestart', 'termsTo lineend')
+        self.mark_unset('termsFrom', 'termsTo')
+
+    def lineBoundary(self, offset):
+        # Start of the line after offset, or offset itself if that's a line start or the line is too long to finish
+        (line, col) = self.locator.indexOf(self.docName, offset)
+        if col == 0:
+            return offset
+        following = self.locator.offsetOf(self.docName, line + 1, 0)
+        return following if following - offset <= self.windowBlock // 4 else offset
+
+    def loadWindow(self, start):
+        # Replace the widget contents with about windowBlock characters of the document from the line holding start
+        (line, col) = self.locator.indexOf(self.docName, start)
+        start = self.locator.offsetOf(self.docName, line, 0)
+        end = self.lineBoundary(min(start + self.windowBlock, self.locator.docLength(self.docName)))
+        self.silent += 1
+        try:
+            self.delete('1.0', 'end-1c')
+            self.insertMarkup('end-1c', self.locator.slice(self.docName, start, end))
+        finally:
+            self.silent -= 1
+        self.windowStart = start
+        self.windowEnd = end
+        self.edit_reset()
+        self.rebuildMarkup()
+
+    def showOffset(self, offset):
+        # Tk index of a document offset, moving the window there first if it isn't loaded
+        if not self.covers(offset, offset):
+            self.loadWindow(max(0, offset - self.windowBlock // 2))
+        return self.offsetIndex(offset)
+
+    def onBookEdit(self, start, end, length):
+        # The Book replaced [start, end) with length characters without going through this widget. Keep the window
+        # on the same text.
+        if end <= self.windowStart:
+            delta = length - (end - start)
+            self.windowStart += delta
+            self.windowEnd += delta
+            self.rebuildMarkup()
+        elif start < self.windowEnd:
+            self.loadWindow(min(start, self.windowStart))
+
+    def onYScroll(self, first, last):
+        if self.scrollCommand is not None:
+            self.scrollCommand(first, last)
+        # Don't change the text from inside Tk's redisplay, look at the view once it's idle
+        if self.hasLocator() and not self.streamPending:
+            self.streamPending = True
+            self.after_idle(self.streamWindow)
+
+    def streamWindow(self):
+        self.streamPending = False
+        if not self.hasLocator():
+            return
+        top = int(self.index('@0,0').split('.')[0])
+        bottom = int(self.index('@0,%d' % self.winfo_height()).split('.')[0])
+        lines = int(self.index('end-1c').split('.')[0])
+        if lines - bottom < self.marginLines and self.windowEnd < self.locator.docLength(self.docName):
+            self.extendWindow(True)
+        elif top <= self.marginLines and self.windowStart > 0:
+            self.extendWindow(False)
+
+    def extendWindow(self, forward):
+        # Load the next block past one edge of the window, trimming the other edge to stay within maxWindow. The
+        # view is put back on the text it was showing. Loading or trimming at the top moves every Tk index, so the
+        # undo history is dropped then.
+        topOffset = self.charOffset('@0,0')
+        docLength = self.locator.docLength(self.docName)
+        self.silent += 1
+        try:
+            if forward:
+                end = self.lineBoundary(min(self.windowEnd + self.windowBlock, docLength))
+                self.insertMarkup('end-1c', self.locator.slice(self.docName, self.windowEnd, end))
+                self.windowEnd = end
+                reset = self.trimWindow(True)
+            else:
+                target = max(self.windowStart - self.windowBlock, 0)
+                start = self.lineBoundary(target)
+                if start >= self.windowStart:
+                    start = target
+                self.insertMarkup('1.0', self.locator.slice(self.docName, start, self.windowStart))
+                self.windowStart = start
+                self.trimWindow(False)
+                reset = True
+        finally:
+            self.silent -= 1
+        if reset:
+            self.edit_reset()
+        self.rebuildMarkup()
+        self.yview(self.offsetIndex(topOffset))
+
+    def trimWindow(self, front):
+        # Drop text from the front or back of the window until it's a block under maxWindow, but never the view or
+        # its margin, so the two edges can't keep trimming each other. True if anything went.
+        excess = self.windowEnd - self.windowStart - self.maxWindow
+        if excess <= 0:
+            return False
+        excess += self.windowBlock
+        if front:
+            limit = self.charOffset('@0,0 - %d lines' % (self.marginLines + 1))
+            cut = min(self.lineBoundary(self.windowStart + excess), limit)
+            if cut <= self.windowStart:
+                return False
+            self.delete('1.0', self.offsetIndex(cut))
+            self.windowStart = cut
+        else:
+            limit = self.charOffset('@0,%d + %d lines' % (self.winfo_height(), self.marginLines + 1))
+            cut = max(self.lineBoundary(self.windowEnd - excess), limit)
+            if cut >= self.windowEnd:
+                return False
+            self.delete(self.offsetIndex(cut), 'end-1c')
+            self.windowEnd = cut
+        return True
+
+    def replaceRange(self, start, end, runs):
+        # Replace chars [start, end) with (text, tags) runs. Goes through the proxy like any other edit.
+        startIdx = self.offsetIndex(start)
+        if end > start:
+            self.delete(startIdx, self.offsetIndex(end))
+        args = []
+        for (text, tags) in runs:
+            args.append(text)
+            args.append(tags)
+        if args:
+            self.insert(startIdx, *args)
+
+    def relIndex(self, anchor, anchorOffset, offset):
+        # Tk index for a char offset, counted back from an index whose offset is known. Tk only walks the distance
+        # between the two, not the whole document prefix.
+        if offset <= anchorOffset:
+            return '%s - %dc' % (anchor, anchorOffset - offset)
+        return '%s + %dc' % (anchor, offset - anchorOffset)
+
     def insert_bullet(self, index, text):
         self.insert(index, f"\u2022 {text}", "bullet")
 
@@ -318,11 +3207,59 @@ class RichText(tk.Text):
 
 
 
-class myEvent:
-    def __init__(self,ch=''):
-        self.char = ch
-    def setChar(self,ch):
-        self.char = ch
+def diffSpan(old, new):
+    # (start, oldEnd, newEnd) such that old[start:oldEnd] -> new[start:newEnd] is the one edit turning old into new,
+    # None if they're equal. Compares in blocks so the common prefix and suffix are found at memcmp speed.
+    if old == new:
+        return None
+    block = 4096
+    limit = min(len(old), len(new))
+    start = 0
+    while start + block <= limit and old[start:start + block] == new[start:start + block]:
+        start += block
+    while start < limit and old[start] == new[start]:
+        start += 1
+    limit -= start
+    tail = 0
+    while tail + block <= limit and old[len(old) - tail - block:len(old) - tail] == new[len(new) - tail - block:len(new) - tail]:
+        tail += block
+    while tail < limit and old[len(old) - tail - 1] == new[len(new) - tail - 1]:
+        tail += 1
+    return (start, len(old) - tail, len(new) - tail)
+
+
+# <name@ text> applies the tag `name` to text. Only complete tags match, a stray '<' or '>' is plain text.
+TAG_PATTERN = re.compile(r'<([^<>@]*)@([^<>]*)>')
+
+
+def tokenizeMarkup(text, bookLinks=False):
+    # Single pass over text yielding (run, tags) pairs that concatenate back to exactly the input.
+    # Tag delimiters come out as 'hidden' runs. With bookLinks, every ']' is also a hidden run.
+    pos = 0
+    for match in TAG_PATTERN.finditer(text):
+        if match.start() > pos:
+            yield from splitLinks(text[pos:match.start()], (), bookLinks)
+        name = match.group(1).strip()
+        yield (text[match.start():match.start(2)], ('hidden',))
+        yield from splitLinks(match.group(2), (name,) if name else (), bookLinks)
+        yield ('>', ('hidden',))
+        pos = match.end()
+    if pos < len(text):
+        yield from splitLinks(text[pos:], (), bookLinks)
+
+
+def splitLinks(text, tags, bookLinks):
+    if not bookLinks or ']' not in text:
+        if text:
+            yield (text, tags)
+        return
+    pieces = text.split(']')
+    for idx in range(len(pieces)):
+        if pieces[idx]:
+            yield (pieces[idx], tags)
+        if idx < len(pieces) - 1:
+            yield (']', ('hidden',))
+
 
 class Application(tk.Frame):
 
@@ -331,16 +3268,50 @@ class Application(tk.Frame):
     activeDoc = -1
     boundDoc = ''
     activeWidget = None
-
-    def __init__(self, master=None):
+    syncing = False
+    navigatorInterval = 0.25
+    watchInterval = 0.5
+    latencyInterval = 1.0
+    latencyPath = 'latency.txt'
+    keyDownAt = None
+    searchLimit = 200
+    termsInterval = 0.2
+    statsInterval = 1.0
+    cloudWords = 60
+    topWordCount = 40
+    readabilityInterval = 2.0
+    yearInterval = 60.0
+    # Words to write this year, for the burndown chart
+    yearGoal = 100000
+
+    # What each pane opens, parsed before the window comes up
+    paneDocs = ('unstructured', 'universeOutline', 'book')
+
+    def __init__(self, master=None, profile=None):
         tk.Frame.__init__(self, master)
-        self.ws = WritingSession()
+        self.profile = profile if profile is not None else StartupProfile(False)
+        self.ws = WritingSession(self.paneDocs, self.profile)
+        self.sync = SyncEngine(self.ws.bk)
+        self.linker = TermLinker(self.ws.bk)
+        self.tooltip = None
         self.pack()
+        self.profile.mark('pane documents parsed')
 
 
         self.createWidgets()
         self.bindCallbacks()
 
+        self.scheduler = Scheduler(self.master)
+        self.ws.schedule(self.scheduler)
+        self.scheduler.addJob('navigator', self.refreshNavigator, self.navigatorInterval, idleInterval=1.0)
+        self.scheduler.addJob('watch', self.applyExternalChanges, self.watchInterval)
+        self.scheduler.addJob('latency', self.refreshLatency, self.latencyInterval)
+        self.scheduler.addJob('terms', self.refreshTerms, self.termsInterval)
+        self.scheduler.addJob('stats', self.refreshStats, self.statsInterval)
+        self.scheduler.addJob('readability', self.refreshReadability, self.readabilityInterval)
+        self.scheduler.addJob('year', self.refreshYear, self.yearInterval)
+        self.scheduler.start()
+
         self.key = ''
 
     def createWidgets(self):
@@ -364,19 +3335,25 @@ class Application(tk.Frame):
         self.docNb.columnconfigure(0, minsize=800, weight=1)
         self.docNb.columnconfigure(1, minsize=800, weight=1)
         self.docNb.columnconfigure(2, minsize=800, weight=1)
+        self.docNb.columnconfigure(3, minsize=200)
         self.masterNb.add(self.docNb,text='Docs')
 
+        # Filled in by buildAnalysis() the first time the tab is opened
         self.analNb = ttk.Frame(self.masterNb)
-        self.fig = Figure()
-        self.plot1 = self.fig.add_subplot(111)
-        self.plot1.plot([0,1,2,3,4],[0,1,2,3,4])
-        self.canvas = FigureCanvasTkAgg(self.fig,master=self.analNb)
-        self.canvas.draw()
-        self.ws.setPlotCanv(self.plot1,self.canvas)
-        self.canvas.get_tk_widget().pack(expand=True,fill=tk.BOTH)
-
+        self.fig = None
         self.masterNb.add(self.analNb, text='Analysis')
 
+        # Year-scale charts from the telemetry rollups, built by buildYear() the first time the tab is opened
+        self.yearNb = ttk.Frame(self.masterNb)
+        self.yearFig = None
+        self.masterNb.add(self.yearNb, text='Year')
+
+        # p50/p95/p99 of every instrumented hook, refreshed while the tab is open
+        self.latencyNb = ttk.Frame(self.masterNb)
+        self.latencyText = tk.Text(self.latencyNb, font='TkFixedFont', state=tk.DISABLED)
+        self.latencyText.pack(expand=True,fill=tk.BOTH)
+        self.masterNb.add(self.latencyNb, text='Latency')
+
 
         ## Setup Tabs
         self.tabControl1 = ttk.Notebook(self.docNb)
@@ -405,6 +3382,21 @@ class Application(tk.Frame):
         self.tabControl2.grid(row=0, column=1, sticky='nsew')
         self.tabControl3.grid(row=0, column=2, sticky='nsew')
 
+        ## Setup Search and Section Navigator
+        self.sidebar = ttk.Frame(self.docNb)
+        self.sidebar.grid(row=0, column=3, sticky='nsew')
+        self.searchEntry = ttk.Entry(self.sidebar)
+        self.searchEntry.pack(side=tk.TOP, fill=tk.X)
+        self.searchStatus = ttk.Label(self.sidebar)
+        self.searchStatus.pack(side=tk.TOP, fill=tk.X)
+        self.searchResults = tk.Listbox(self.sidebar, exportselection=False, activestyle='none', height=15)
+        self.searchResults.pack(side=tk.TOP, fill=tk.X)
+        self.searchHits = []
+
+        self.navigator = tk.Listbox(self.sidebar, exportselection=False, activestyle='none')
+        self.navigator.pack(side=tk.TOP, expand=True, fill=tk.BOTH)
+        self.navigatorShows = None
+
 
         ## Setup Text Edit Areas
         self.text_edit1 = RichText(self.tab1, undo=True)
@@ -418,17 +3410,37 @@ class Application(tk.Frame):
 
         self.bookWidget = self.text_edit3
 
+        for txt_wgt in (self.text_edit1, self.text_edit2, self.text_edit3):
+            txt_wgt.onEdit = self.onTextEdit
+            txt_wgt.locator = self.ws.bk
+            # Widget bindings run before the Text class binding that inserts the key, so this is when a keypress starts
+            txt_wgt.bind('<KeyPress>', self.onKeyDown, add='+')
+            txt_wgt.bind('<<Paste>>', self.onPasteStart, add='+')
+            txt_wgt.tag_bind('term', '<Enter>', self.onTermEnter)
+            txt_wgt.tag_bind('term', '<Leave>', self.onTermLeave)
+            txt_wgt.tag_bind('term', '<Control-Button-1>', self.onTermClick)
+
+        self.profile.mark('widgets created')
+
         # Load Documents
-        self.loadDoc(self.text_edit1,'unstructured')
-        self.loadDoc(self.text_edit2, 'universeOutline')
-        self.loadDoc(self.text_edit3, 'book')
+        self.loadDoc(self.text_edit1, self.paneDocs[0])
+        self.loadDoc(self.text_edit2, self.paneDocs[1])
+        self.loadDoc(self.text_edit3, self.paneDocs[2])
+        self.profile.mark('pane documents shown')
         # initial time display
         self.onUpdate()
 
     def bindCallbacks(self):
+        self.master.bind('<FocusIn>', self.onFocusChange)
         self.master.bind('<KeyPress>', self.onKeyPress)
         self.master.bind('<BackSpace>', self.onBackSpace)
         self.master.bind('<<Paste>>', self.onPaste)
+        # Ctrl+Shift+L writes the latency report to latencyPath
+        self.master.bind('<Control-L>', self.onDumpLatency)
+        self.masterNb.bind('<<NotebookTabChanged>>', self.onMasterTabChanged)
+        self.navigator.bind('<<ListboxSelect>>', self.onNavigate)
+        self.searchEntry.bind('<Return>', self.onSearch)
+        self.searchResults.bind('<<ListboxSelect>>', self.onSearchHit)
 
         self.tabControl1.bind("<Button-3>", self.onTabRightClick1)
         self.tabControl2.bind("<Button-3>", self.onTabRightClick2)
@@ -440,21 +3452,200 @@ class Application(tk.Frame):
 
 
 
+    def onMasterTabChanged(self,event):
+        shown = self.masterNb.select() == str(self.analNb)
+        if shown and self.fig is None:
+            self.buildAnalysis()
+        if self.ws.livePlot is not None:
+            self.ws.livePlot.setVisible(shown)
+        if self.masterNb.select() == str(self.yearNb):
+            if self.yearFig is None:
+                self.buildYear()
+            self.refreshYear()
+
+    def buildAnalysis(self):
+        # matplotlib is imported here rather than at launch, it's the slowest part of starting up
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
+        # Word statistics under the plot: the most used words with their use over the book, and a word cloud
+        self.statsFrame = ttk.Frame(self.analNb)
+        self.statsFrame.pack(side=tk.BOTTOM, fill=tk.X)
+        self.topWordsText = tk.Text(self.statsFrame, font='TkFixedFont', width=48, height=20, state=tk.DISABLED)
+        self.topWordsText.pack(side=tk.LEFT, fill=tk.Y)
+        self.cloud = tk.Canvas(self.statsFrame, height=320, background='white')
+        self.cloud.pack(side=tk.LEFT, expand=True, fill=tk.BOTH)
+        self.statsShows = None
+
+        # Readability of each section of the book, filled in as the worker pool gets through them
+        self.readFig = Figure(figsize=(8, 2.5))
+        self.readPlot = self.readFig.add_subplot(111)
+        self.readGrade = self.readPlot.twinx()
+        self.readCanvas = FigureCanvasTkAgg(self.readFig, master=self.analNb)
+        self.readCanvas.get_tk_widget().pack(side=tk.BOTTOM, fill=tk.X)
+
+        self.fig = Figure()
+        self.plot1 = self.fig.add_subplot(111)
+        self.canvas = FigureCanvasTkAgg(self.fig,master=self.analNb)
+        self.canvas.draw()
+        self.ws.setPlotCanv(self.plot1,self.canvas)
+        self.canvas.get_tk_widget().pack(expand=True,fill=tk.BOTH)
+
+    def buildYear(self):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        self.yearFig = Figure()
+        (self.burnPlot, self.hoursPlot, self.yearWpmPlot) = [self.yearFig.add_subplot(3, 1, i) for i in (1, 2, 3)]
+        self.yearCanvas = FigureCanvasTkAgg(self.yearFig, master=self.yearNb)
+        self.yearCanvas.get_tk_widget().pack(expand=True,fill=tk.BOTH)
+
+    def refreshYear(self):
+        # Word goal burndown from the day rollups, time spent and average WPM from the week rollups: at most a few
+        # hundred rows for the whole year
+        if self.yearFig is None or self.ws.tm is None or not self.masterNb.select() == str(self.yearNb):
+            return
+        import datetime
+        rollup = self.ws.tm.rollup
+        year = time.localtime().tm_year
+        yearStart = time.mktime((year, 1, 1, 0, 0, 0, 0, 0, -1))
+        yearEnd = time.mktime((year + 1, 1, 1, 0, 0, 0, 0, 0, -1))
+        days = rollup.read('day', yearStart, yearEnd)
+        weeks = rollup.read('week', yearStart, yearEnd)
+        dayDates = [datetime.datetime.fromtimestamp(rollup.bucketStart('day', b)) for b in days['bucket']]
+        weekDates = [datetime.datetime.fromtimestamp(rollup.bucketStart('week', b)) for b in weeks['bucket']]
+        for ax in (self.burnPlot, self.hoursPlot, self.yearWpmPlot):
+            ax.clear()
+
+        startDate = datetime.datetime.fromtimestamp(yearStart)
+        endDate = datetime.datetime.fromtimestamp(yearEnd)
+        self.burnPlot.plot([startDate, endDate], [self.yearGoal, 0], linestyle='--', label='goal')
+        if len(days):
+            self.burnPlot.plot(dayDates, self.yearGoal - np.cumsum(days['words']), label='words left')
+        self.burnPlot.set_title('%d word goal' % self.yearGoal, fontsize='small')
+        self.burnPlot.legend(loc='upper right', fontsize='small')
+
+        self.hoursPlot.bar(weekDates, weeks['active'] / 3600.0, width=6)
+        self.hoursPlot.set_title('Hours writing per week', fontsize='small')
+
+        active = weeks['active'] / 60.0
+        wpm = np.divide(weeks['chars'] / 5.0, active, out=np.zeros(len(weeks)), where=active > 0)
+        self.yearWpmPlot.plot(weekDates, wpm, marker='.')
+        self.yearWpmPlot.set_title('Average WPM per week (%d sessions)' % int(weeks['sessions'].sum()),
+                                   fontsize='small')
+        for ax in (self.burnPlot, self.hoursPlot, self.yearWpmPlot):
+            ax.set_xlim([startDate, endDate])
+        self.yearFig.tight_layout()
+        self.yearCanvas.draw_idle()
+
+    def refreshStats(self):
+        # Only while the Analysis tab is open, and only redrawn when the counts changed
+        if self.fig is None or not self.masterNb.select() == str(self.analNb):
+            return
+        stats = self.ws.bk.search.updateStats()
+        if stats.version == self.statsShows:
+            return
+        self.statsShows = stats.version
+        top = stats.topWords(max(self.cloudWords, self.topWordCount))
+
+        # One row per word: count, share of all words, and a sparkline of its use from the start of the book to the end
+        blocks = '\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+        lines = ['%-14s %7s %6s  %s' % ('word', 'count', '%', 'use over ' + stats.positionDoc)]
+        for (word, count) in top[:self.topWordCount]:
+            usage = stats.usage(word)
+            peak = max(usage) or 1.0
+            spark = ''.join(blocks[min(int(u / peak * len(blocks)), len(blocks) - 1)] for u in usage)
+            lines.append('%-14s %7d %6.2f  %s' % (word[:14], count, 100.0 * count / max(stats.words, 1), spark))
+        self.topWordsText.configure(state=tk.NORMAL)
+        self.topWordsText.delete('1.0', tk.END)
+        self.topWordsText.insert('1.0', '\n'.join(lines))
+        self.topWordsText.configure(state=tk.DISABLED)
+        self.drawCloud(top[:self.cloudWords])
+
+    def refreshReadability(self):
+        # Only while the Analysis tab is open. Picks up finished sections and hands changed ones to the pool.
+        if self.fig is None or not self.masterNb.select() == str(self.analNb):
+            return
+        tracker = self.ws.readability
+        if not tracker.update():
+            return
+        series = tracker.series()
+        sections = list(range(len(series)))
+        nan = float('nan')
+        (ease, grade, complexity) = [[s[i] if s is not None else nan for s in series] for i in range(3)]
+        self.readPlot.clear()
+        self.readGrade.clear()
+        self.readPlot.plot(sections, ease, label='Flesch reading ease')
+        self.readPlot.plot(sections, complexity, label='% complex sentences')
+        self.readGrade.plot(sections, grade, color='tab:red', label='Flesch-Kincaid grade')
+        self.readPlot.set_xlabel('section of ' + tracker.metricsDoc)
+        self.readPlot.legend(loc='upper left', fontsize='small')
+        self.readGrade.legend(loc='upper right', fontsize='small')
+        overall = tracker.overall()
+        if overall is not None:
+            self.readPlot.set_title('Reading ease %.1f, grade %.1f, %.0f%% complex sentences' % overall, fontsize='small')
+        if tracker.running:
+            self.readPlot.set_title('%d sections still being measured' % len(tracker.running), loc='right', fontsize='small')
+        self.readCanvas.draw_idle()
+
+    def drawCloud(self, words):
+        # Words in rows, font size by the square root of their count relative to the most used one
+        self.cloud.delete('all')
+        if not words:
+            return
+        width = max(self.cloud.winfo_width(), 200)
+        family = tkFont.nametofont('TkDefaultFont').cget('family')
+        colours = ('#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b')
+        most = words[0][1]
+        (x, y, rowHeight) = (8, 8, 0)
+        for (i, (word, count)) in enumerate(words):
+            size = int(10 + 26 * math.sqrt(count / most))
+            item = self.cloud.create_text(x, y, text=word, anchor='nw', font=(family, size, 'bold'),
+                                          fill=colours[i % len(colours)])
+            (x0, y0, x1, y1) = self.cloud.bbox(item)
+            if x1 > width - 8 and x > 8:
+                # Doesn't fit, start the next row
+                (x, y, rowHeight) = (8, y + rowHeight + 4, 0)
+                self.cloud.coords(item, x, y)
+                (x0, y0, x1, y1) = self.cloud.bbox(item)
+            x = x1 + 12
+            rowHeight = max(rowHeight, y1 - y0)
+
+    def refreshLatency(self):
+        if not self.masterNb.select() == str(self.latencyNb):
+            return
+        self.latencyText.configure(state=tk.NORMAL)
+        self.latencyText.delete('1.0', tk.END)
+        self.latencyText.insert('1.0', latency.report())
+        self.latencyText.configure(state=tk.DISABLED)
+
+    def onDumpLatency(self,event):
+        latency.dump(self.latencyPath)
+        print("Latency report written to", self.latencyPath)
+
+    def onKeyDown(self,event):
+        self.keyDownAt = time.perf_counter()
+
+    def keyRendered(self, pressed):
+        # Runs once Tk is idle after a keypress, which is after it has redrawn the edit
+        latency.record('key.toIdle', time.perf_counter() - pressed)
+
+    @timed('Application.onPaste')
     def onPaste(self,event):
-        print(event.__dict__)
-        print("clipboard",self.master.clipboard_get())
-
-        #self.activeWidget.edit_undo()
-        for ch in self.master.clipboard_get():
-            ev = myEvent(ch)
-            self.onKeyPress(ev)
-
-        #self.ws.bk.setSection(self.boundDoc, 0, self.activeWidget.get('1.0', 'end-1c'))
-        #self.ws.bk.saveAll()
-        #self.ws.bk.loadDocTree()
-        #for doc in self.ws.bk.allPaths:
-        #    print(doc)
-        #    self.loadDoc(self.bookWidget, doc)
+        self.scheduler.poke()
+
+        # The Text class binding has already inserted the clipboard with a single insert, bracketed by undo
+        # separators, so the proxy passed it to the Book as one delta and undo sees one entry. All that is left is
+        # one scan of the pasted block for markup to apply.
+        # Only a paste into the pane itself, and only if it inserted anything (onPasteStart cleared lastInserted)
+        widget = self.activeWidget
+        if widget is None or event.widget is not widget or not widget.lastInserted:
+            return
+        self.applyMarkup(widget, widget.lastInsertedAt, widget.lastInserted)
+
+    def onPasteStart(self,event):
+        # Widget binding, runs before the Text class binding inserts the clipboard
+        event.widget.lastInserted = ''
+
     def onTabRightClick1(self,event):
         clicked_tab = self.tabControl1.tk.call(self.tabControl1._w, "identify", "tab", event.x, event.y)
 
@@ -503,46 +3694,21 @@ class Application(tk.Frame):
             self.tabControl3.select(index)
 
     def loadDoc(self,txt_wgt, docName):
-        txt_wgt.delete('1.0','end-1c')
-        procSection = []
-        for section in self.ws.bk.docTree[docName]:
-            tagSplit = section.split('<')
-            cpTagSplit = tagSplit.copy()
-            countTag = 0
-            for tidx in range(len(tagSplit)):
-                splitTagSplit = tagSplit[tidx].split('>')
-                if len(splitTagSplit) > 1:
-                    cpTagSplit[tidx + countTag] = splitTagSplit[0]
-                    cpTagSplit.insert(tidx + 1 + countTag, splitTagSplit[1])
-                    countTag = countTag + 1
-
-            tagSplit = cpTagSplit.copy()
-            for taggedSection in tagSplit:
-                if '@' in taggedSection:
-                    splitTaggedSection = taggedSection.split("@")
-                    procSection.append('<'+splitTaggedSection[0]+'@')
-                    procSection.append(splitTaggedSection[1])
-                    procSection.append('>')
-                    txt_wgt.insert(tk.INSERT, '<'+splitTaggedSection[0]+'@', 'hidden')
-                    if ']' in splitTaggedSection[1] and docName == 'book': # TODO This is where I would add the logic to add tags to link back to the original section. Or tags to link back to proper nouns.
-                        splitBookTags  = splitTaggedSection[1].split(']')
-                        for glomp in splitBookTags:
-                            txt_wgt.insert(tk.INSERT, glomp, splitTaggedSection[0].strip())
-                            txt_wgt.insert(tk.INSERT, ']', 'hidden')
-                    else:
-                        txt_wgt.insert(tk.INSERT, splitTaggedSection[1], splitTaggedSection[0].strip())
-                    txt_wgt.insert(tk.INSERT, '>', 'hidden')
-                else:
-                    procSection.append('<@')
-                    procSection.append(taggedSection)
-                    procSection.append('>')
-                    if ']' in taggedSection and docName == 'book':
-                        splitBookTags  = taggedSection.split(']')
-                        for glomp in splitBookTags:
-                            txt_wgt.insert(tk.INSERT, glomp, [])
-                            txt_wgt.insert(tk.INSERT, ']', 'hidden')
-                    else:
-                        txt_wgt.insert(tk.INSERT, taggedSection, [])
+        # The pane gets the first window of the document from the Book and streams the rest in as it scrolls.
+        # Loading is silent, it must not be reported back as edits.
+        txt_wgt.docName = docName
+        # ']' is only a link delimiter in the formatted book
+        txt_wgt.bookLinks = docName == 'book'
+        txt_wgt.loadWindow(0)
+
+        # Edits are applied to the Book by offset, so the window and the Book have to agree. tokenizeMarkup
+        # round-trips exactly, so a difference is a bug; report it, opening a pane must never change the document.
+        widgetText = txt_wgt.get('1.0', 'end-1c')
+        bookText = self.ws.bk.slice(docName, txt_wgt.windowStart, txt_wgt.windowEnd)
+        if not widgetText == bookText:
+            (start, _, _) = diffSpan(bookText, widgetText)
+            print("Pane text differs from", docName, "at offset", txt_wgt.windowStart + start)
+
     def onUpdate(self):
         if(self.focus_get() == self.text_edit1):
             self.activeDoc = 0
@@ -560,120 +3726,280 @@ class Application(tk.Frame):
             self.activeDoc = -1
             self.boundDoc = ''
 
-        self.ws.update()
-
-
-    def onKeyPress(self,event):
-        self.ws.bk.setSection(self.boundDoc,0,self.activeWidget.get('1.0','end-1c'))
-
-        if event.char == '>':
-            stringIdx = self.activeWidget.index(tk.INSERT)
-
-            numCharConsumed = 0
-
-            relText = self.activeWidget.get('1.0', stringIdx)
-            #' <bold@ Prologue>'
-            splitText = relText.split('>')
-            numCharConsumed = numCharConsumed + len(splitText) -1
-            #' <bold@ Prologue',''
-            splitText = splitText[-2].split('<')
-            numCharConsumed = numCharConsumed + len(splitText) - 1
-            # ' ','bold@ Prologue'
-            hideText = splitText[1]
-
-
-            #'bold@ Prologue'
-            splitHideText = hideText.split('@')
-            numCharConsumed = numCharConsumed + len(splitText) - 1
-            numHideConsumed = numCharConsumed
-            # 'bold',' Prologue'
-
-
-            if len(splitText) > 1:
-                numText = len(splitHideText[0]) + len(splitHideText[1]) + 3
-                # 'bold@ Prologue' -> 14 + 2 = 16 (2 is the number of chars consumed in splits)
-                numAtText = len(splitHideText[0]) + 2
-                # 'bold' -> 4 + 3 = 7 (3 is the number of chars consumed in splits
-                self.activeWidget.hideText(stringIdx + '- 1c', stringIdx)
-                # ' <bold@ Prologue>'
-                self.activeWidget.hideText(stringIdx + '- %dc' % (numText), stringIdx + '- %dc' % (numText-numAtText))
-                self.activeWidget.applyTag(stringIdx + '- %dc' %  (numText-numAtText),stringIdx+ '- 1c',splitHideText[0])
-
-
-        if event.char == ']':
-            stringIdx = self.activeWidget.index(tk.INSERT)
-
-            numCharConsumed = 0
-
-            relText = self.activeWidget.get('1.0', stringIdx)
-
-            #' <bold@ Prologue>'
-            splitText = relText.split(']')
-            countBookSects = len(splitText) -2 # Num of ']'
-
-            numCharConsumed = numCharConsumed + len(splitText) -1
-            #' <bold@ Prologue',''
-            splitText = splitText[-2].split('[')
-            numCharConsumed = numCharConsumed + len(splitText) - 1
-            # ' ','bold@ Prologue'
-            hideText = splitText[1]
+    def onFocusChange(self,event):
+        self.onUpdate()
+        self.refreshNavigator()
 
+    def refreshNavigator(self):
+        # List the sections of the document in the last focused pane. Only redrawn when the Book reports that
+        # document's sections or headings changed.
+        widget = self.activeWidget
+        if widget is None or widget.docName not in self.ws.bk.docTree:
+            return
+        docName = widget.docName
+        shows = (docName, self.ws.bk.sectionVersion[docName])
+        if shows == self.navigatorShows:
+            return
+        self.navigatorShows = shows
+        self.navigator.delete(0, tk.END)
+        for section in range(len(self.ws.bk.sections[docName])):
+            self.navigator.insert(tk.END, self.ws.bk.sectionTitle(docName, section) or '(%s)' % docName)
+
+    def onNavigate(self,event):
+        # Jump the pane the navigator is listing to the start of the chosen section
+        selection = self.navigator.curselection()
+        if not selection or self.navigatorShows is None:
+            return
+        widget = self.widgetFor(self.navigatorShows[0])
+        if widget is None or selection[0] >= len(self.ws.bk.sections[widget.docName]):
+            return
+        index = widget.showOffset(self.ws.bk.sectionStart(widget.docName, selection[0]))
+        widget.mark_set(tk.INSERT, index)
+        widget.see(index)
+        widget.focus_set()
+
+    def onSearch(self,event):
+        bk = self.ws.bk
+        start = time.perf_counter()
+        self.searchHits = bk.search.search(self.searchEntry.get(), self.searchLimit)
+        elapsed = time.perf_counter() - start
+        self.searchResults.delete(0, tk.END)
+        for (docName, section, hitStart, hitEnd) in self.searchHits:
+            context = bk.slice(docName, max(0, hitStart - 20), hitEnd + 40).replace('\n', ' ')
+            self.searchResults.insert(tk.END, '%s: %s' % (bk.sectionTitle(docName, section) or docName, context))
+        more = '+' if len(self.searchHits) >= self.searchLimit else ''
+        self.searchStatus.configure(text='%d%s hits in %.1f ms' % (len(self.searchHits), more, elapsed * 1000))
+
+    def onSearchHit(self,event):
+        selection = self.searchResults.curselection()
+        if not selection or selection[0] >= len(self.searchHits):
+            return
+        (docName, section, start, end) = self.searchHits[selection[0]]
+        self.showDoc(docName, start, end)
 
-            #'bold@ Prologue'
-            splitHideText = hideText.split('|')
-            numCharConsumed = numCharConsumed + len(splitText) - 1
-            numHideConsumed = numCharConsumed
-            # 'bold',' Prologue'
+    def showDoc(self, docName, start, end, avoid=None):
+        # Jump to [start, end) of a document and select it. A document no pane is showing opens in the last focused
+        # pane, or another one if that's avoid.
+        if docName not in self.ws.bk.docTree:
+            return
+        widget = self.widgetFor(docName)
+        if widget is None:
+            panes = (self.activeWidget, self.text_edit1, self.text_edit2, self.text_edit3)
+            widget = [pane for pane in panes if pane is not None and pane is not avoid][0]
+            self.loadDoc(widget, docName)
+        end = min(end, self.ws.bk.docLength(docName))
+        index = widget.showOffset(start)
+        widget.tag_remove('sel', '1.0', tk.END)
+        if widget.covers(start, end):
+            widget.tag_add('sel', index, widget.offsetIndex(end))
+        widget.mark_set(tk.INSERT, index)
+        widget.see(index)
+        widget.focus_set()
+
+    def refreshTerms(self):
+        # Swap in a rebuilt matcher, or re-tag just the lines edited since the last run
+        matcher = self.linker.update()
+        for txt_wgt in (self.text_edit1, self.text_edit2, self.text_edit3):
+            if matcher is not None:
+                txt_wgt.setMatcher(matcher)
+            else:
+                txt_wgt.retagTerms()
+
+    def termUnder(self, event):
+        # The defined term under the mouse
+        widget = event.widget
+        index = widget.index('@%d,%d' % (event.x, event.y))
+        line = widget.get(index + ' linestart', index + ' lineend')
+        return self.linker.termAt(line, int(index.split('.')[1]))
+
+    def onTermEnter(self,event):
+        term = self.termUnder(event)
+        found = self.linker.definitionOf(term) if term is not None else None
+        if found is None:
+            return
+        (docName, section) = found
+        body = self.ws.bk.docTree[docName][section].slice(0, 600).split('\n', 1)[-1].strip()
+        if len(body) > 400:
+            body = body[:400] + '...'
+        text = '%s (%s)\n%s\nCtrl+click to open' % (term, docName, body)
+        if self.tooltip is None:
+            self.tooltip = tk.Toplevel(self.master)
+            self.tooltip.wm_overrideredirect(True)
+            self.tooltipLabel = tk.Label(self.tooltip, justify=tk.LEFT, wraplength=400, background='#ffffe0',
+                                         relief=tk.SOLID, borderwidth=1)
+            self.tooltipLabel.pack()
+        self.tooltipLabel.configure(text=text)
+        self.tooltip.wm_geometry('+%d+%d' % (event.x_root + 12, event.y_root + 12))
+        self.tooltip.deiconify()
+
+    def onTermLeave(self,event):
+        if self.tooltip is not None:
+            self.tooltip.withdraw()
+
+    def onTermClick(self,event):
+        # Open the definition, in another pane than the one clicked in
+        term = self.termUnder(event)
+        found = self.linker.definitionOf(term) if term is not None else None
+        if found is None:
+            return
+        self.onTermLeave(event)
+        (docName, section) = found
+        start = self.ws.bk.sectionStart(docName, section)
+        self.showDoc(docName, start, start, avoid=event.widget)
+        return 'break'
+
+    def onClose(self):
+        self.scheduler.stop()
+        self.ws.close()
+        self.master.destroy()
+
+
+    def applyExternalChanges(self):
+        # Apply what the DocWatcher found. Only the span that differs is replaced, in the Book and in any pane showing
+        # the document, and it isn't synced on to linked documents since those files come from the same source.
+        bk = self.ws.bk
+        for (docName, text, stamp) in self.ws.watcher.changes():
+            if text is None:
+                # Removed on disk. A document still open in a pane is kept and written again when it's next edited.
+                if self.widgetFor(docName) is None:
+                    bk.dropDoc(docName)
+                    if docName in bk.allPaths:
+                        bk.allPaths.remove(docName)
+                continue
+            if docName not in bk.docTree:
+                bk.parseDoc(docName, text)
+                bk.allPaths = sorted(bk.allPaths + [docName])
+            elif bk.saver.isDirty(docName):
+                # Never throw unsaved edits away: keep them, they're written over the file as usual, and save what
+                # was on disk next to it
+                copy = bk.keepDiskCopy(docName, text)
+                print(docName, "changed on disk while it had unsaved edits. Kept the edits, the version from disk is in",
+                      copy)
+                bk.fileStamps[docName] = stamp
+                continue
+            else:
+                edit = bk.changedRange(docName, text)
+                if edit is not None:
+                    self.applyDocEdits([(docName,) + edit])
+            bk.fileStamps[docName] = stamp
+            bk.saver.markClean(docName)
+
+    @timed('Application.onTextEdit')
+    def onTextEdit(self,widget,op,offset,text):
+        # Called by RichText for every change to its text. Applies the same change to the Book.
+        docName = widget.docName
+        if docName not in self.ws.bk.docTree:
+            return
+        if op == 'insert':
+            self.ws.bk.insertAt(docName, offset, text)
+        else:
+            self.ws.bk.deleteAt(docName, offset, len(text))
+        if not self.syncing:
+            self.applyDocEdits(self.sync.propagate(docName, op, offset, text))
 
+    @timed('Application.onKeyPress')
+    def onKeyPress(self,event):
+        # Queued after the redraw the Text binding's insert has already queued
+        self.master.after_idle(self.keyRendered, self.keyDownAt or time.perf_counter())
+        self.keyDownAt = None
+        self.scheduler.poke()
+
+        widget = self.activeWidget
+        # Only keys typed into the pane itself, not the search box
+        if event.char not in ('>', ']') or widget is None or event.widget is not widget \
+                or not widget.lastInserted == event.char:
+            return
 
-            if len(splitText) > 1:
-                numText = len(splitHideText[0]) + len(splitHideText[1]) + 3
-                # 'bold@ Prologue' -> 14 + 2 = 16 (2 is the number of chars consumed in splits)
-                numAtText = len(splitHideText[0]) + 2
-                # 'bold' -> 4 + 3 = 7 (3 is the number of chars consumed in splits
-                #self.activeWidget.hideText(stringIdx + '- 1c', stringIdx)
-                # ' <bold@ Prologue>'
-                #self.activeWidget.hideText(stringIdx + '- %dc' % (numText), stringIdx + '- %dc' % (numText-numAtText))
-                #self.activeWidget.applyTag(stringIdx + '- %dc' %  (numText-numAtText),stringIdx+ '- 1c',splitHideText[0])
-                targets = splitHideText[0].split(',')
-
-                for target in targets:
-                    sect = self.activeWidget.get(stringIdx + '- %dc' %  (numText-numAtText),stringIdx+ '- 1c')
-
-                    splitBook = self.ws.bk.docTree[target][0].split(']')
-
-                    sumStr = ''
-                    for spl in range(len(splitBook)):
-                        if spl == countBookSects:
-                            sumStr = sumStr + sect + ']'
-                        elif not splitBook[spl] == '':
-                            sumStr = sumStr + splitBook[spl] + ']'
-
-                    self.ws.bk.setSection(target,0,sumStr)
-                    self.ws.bk.saveAll()
-                    self.ws.bk.loadDocTree()
-                    self.loadDoc(self.bookWidget,target)
+        # The Text binding has already inserted the closer and the proxy recorded its offset
+        self.applyMarkup(widget, widget.lastInsertedAt, event.char)
+
+    def applyMarkup(self, widget, offset, text):
+        # Handle every '>' and ']' in text, which was just inserted at offset and ends at the cursor. The markup index
+        # finds each matching opener without rescanning the text in front of it.
+        anchor = widget.index(tk.INSERT)
+        anchorOffset = offset + len(text)
+        for match in re.finditer('[>\]]', text):
+            close = offset + match.start()
+            index = widget.tagIndex if match.group() == '>' else self.ws.bk.links[widget.docName]
+            found = index.findOpener(close)
+            if found is None or found[1] is None:
+                continue
+            (opener, sep) = found
+            if match.group() == '>':
+                self.onTagClosed(widget, anchor, anchorOffset, opener, sep, close)
+            else:
+                self.onLinkClosed(widget, anchor, anchorOffset, opener, sep, close)
+
+    def onTagClosed(self, widget, anchor, anchorOffset, opener, sep, close):
+        # ' <bold@ Prologue>' -> hide '<bold@' and '>', tag ' Prologue' with bold. Only this span is touched.
+        (openIdx, sepIdx, closeIdx) = [widget.relIndex(anchor, anchorOffset, p) for p in (opener, sep, close)]
+        name = widget.get(openIdx + ' + 1c', sepIdx)
+        widget.hideText(closeIdx, closeIdx + ' + 1c')
+        widget.hideText(openIdx, sepIdx + ' + 1c')
+        widget.applyTag(sepIdx + ' + 1c', closeIdx, name.strip())
+
+    def onLinkClosed(self, widget, anchor, anchorOffset, opener, sep, close):
+        # '[book|Some text]' -> copy the passage into the matching ']'-delimited segment of each target document
+        links = self.ws.bk.links[widget.docName]
+        self.applyDocEdits(self.sync.linkClosed(widget.docName, links.closersBefore(links.firstAtOrAfter(close))))
+
+    def widgetFor(self, docName):
+        for txt_wgt in (self.text_edit1, self.text_edit2, self.text_edit3):
+            if txt_wgt.docName == docName:
+                return txt_wgt
+        return None
+
+    def applyDocEdits(self, edits):
+        # Apply edits from the SyncEngine. Only the given ranges change, in the Book and in any pane showing the
+        # document. Nothing is reloaded; the saver picks the documents up as dirty.
+        self.syncing = True
+        try:
+            for (docName, start, end, text) in edits:
+                self.applyDocEdit(docName, start, end, text)
+        finally:
+            self.syncing = False
+
+    def applyDocEdit(self, docName, start, end, text):
+        txt_wgt = self.widgetFor(docName)
+        if txt_wgt is None or not txt_wgt.covers(start, end):
+            # Not on screen, only the Book changes. A pane showing another part of the document keeps its window on
+            # the same text.
+            if end > start:
+                self.ws.bk.deleteAt(docName, start, end - start)
+            self.ws.bk.insertAt(docName, start, text)
+            if txt_wgt is not None:
+                txt_wgt.onBookEdit(start, end, len(text))
+            return
+        if start == end and start > 0 and re.search('[<>\\]]', text) is None:
+            # Typing mirrored into the middle of formatted text picks up the formatting around it
+            tags = [t for t in txt_wgt.tag_names(txt_wgt.offsetIndex(start - 1)) if t not in ('hidden', 'sel')]
+            runs = [(text, tuple(tags))]
+        else:
+            runs = list(tokenizeMarkup(text, docName == 'book'))
+        # Edits on the pane reach the Book through the proxy
+        txt_wgt.replaceRange(start, end, runs)
 
+    @timed('Application.onBackSpace')
     def onBackSpace(self,event):
-        self.ws.bk.setSection(self.boundDoc, 0, self.activeWidget.get('1.0', 'end-1c'))
+        self.scheduler.poke()
 
-        stringIdx = self.activeWidget.index(tk.INSERT)
-        self.activeWidget.edit_undo()
-        chair = self.activeWidget.get(stringIdx+' - 0c', stringIdx+' + 1c')
-        self.activeWidget.edit_redo()
+        # Only a backspace in the pane itself, not the search box
+        widget = self.activeWidget
+        if widget is None or event.widget is not widget:
+            return
 
-        if chair == '>':
-            # Search backwards and find the beginning of the tag index so we can unhide it
-            relText = self.activeWidget.get('1.0', stringIdx)
-            splitText = relText.split('>')
-            if len(splitText) > 1:
-                splitText = splitText[-1].split('<')
-            else:
-                splitText = relText.split('<')
+        # The Text class binding has already deleted the character, RichText kept a copy of it
+        stringIdx = widget.index(tk.INSERT)
+        chair = ''
+        if widget.lastDeletedAt == widget.charOffset(stringIdx):
+            chair = widget.lastDeleted[:1]
 
-            if len(splitText) > 1:
-                numText = len(splitText[-1]) + 1
-                self.activeWidget.unhideText(stringIdx + '- %dc' %(numText),stringIdx)
+        if chair == '>':
+            # Find the beginning of the now unclosed tag so we can unhide it
+            cursor = widget.lastDeletedAt
+            found = widget.tagIndex.findOpener(cursor)
+            if found is not None:
+                widget.unhideText(widget.relIndex(stringIdx, cursor, found[0]), stringIdx)
         '''  
         if chair == ']':
             # Search backwards and find the beginning of the tag index so we can unhide it
@@ -694,19 +4020,19 @@ class Application(tk.Frame):
 # TODO: ****Add start/stop/pause buttons to control whether to record telemetry
 # DONETODO: Add formatting to text box? https://stackoverflow.com/questions/63099026/fomatted-text-in-tkinter
 # DONETODO: Add system for parsing out what is part of the book and what isn't -> make the system work both ways (maybe need intermediary document which tracks the links between each document?). Possibly tags to identify where to put things
-# TODO: Make the book parsing work in reverse
-# TODO: Add a navigator for seeing the sections of the book that lets you jump to each 'section' (indicated by the ##)
-    #TODO: Prerequisite fix this so it properly supports multiple sections instead of assuming section 0
+# DONETODO: Make the book parsing work in reverse
+# DONETODO: Add a navigator for seeing the sections of the book that lets you jump to each 'section' (indicated by the ##)
+    #DONETODO: Prerequisite fix this so it properly supports multiple sections instead of assuming section 0
 # TODO: ***Add timer to ui
 # TODO: ***Add total word count and session word counnt to UI
 # TODO: Add scroll bars to text boxes
-# TODO: Automatic interactive hyperlinks to proper nouns would be cool https://stackoverflow.com/questions/72407200/tkinter-text-that-executes-functions-on-click-highlights-when-cursor-hovers
+# DONETODO: Automatic interactive hyperlinks to proper nouns would be cool https://stackoverflow.com/questions/72407200/tkinter-text-that-executes-functions-on-click-highlights-when-cursor-hovers
 # 1. Set up definitions in documents (with tags I define or something like <definition> <\definition>)
 # 2. Could also use to link to character sheets or location sheets (not really definitions) would need some way to establish them as keywords (tags?)
 # 3. Search text for those words and apply formatting change to underline them or something
 # 4. Detect mouse hover over those words and open tool-tip with description
 # 5. On click, scroll to the definition
-# TODO: Word cloud, word usage statistics
+# DONETODO: Word cloud, word usage statistics
 # 1. List of most common words
 # 2. Word usage breakdown by runtime of book
 # 3. Sentence complexity
@@ -714,9 +4040,9 @@ class Application(tk.Frame):
 # 5. Reading level over whole book
 # DONETODO: embed plots in gui https://matplotlib.org/3.1.0/gallery/user_interfaces/embedding_in_tk_sgskip.html
 # TODO: Make interface dynamic -> can load and unload documents to each pane, maybe change number of panes? https://www.geeksforgeeks.org/creating-tabbed-widget-with-python-tkinter/
-# TODO: *Make a word goal and burndown chart for the year
-# TODO: *Make a time spent chart for the year
-# TODO: *Make an average wpm/session chart over the year
+# DONETODO: *Make a word goal and burndown chart for the year
+# DONETODO: *Make a time spent chart for the year
+# DONETODO: *Make an average wpm/session chart over the year
 # TODO: Docking and undocking the plotting tabs
 if __name__ == '__main__':
 
@@ -724,21 +4050,31 @@ if __name__ == '__main__':
 
 
 
-    root = tk.Tk()
-    app = Application(master=root)
-    running = True
-    while running:
-        root.update()
-        root.update_idletasks()
+    parser = argparse.ArgumentParser(description='Writing app')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='print how long each step of startup takes and a profile of the slowest calls')
+    parser.add_argument('--rebuild-rollups', action='store_true',
+                        help='recompute the minute/hour/day/week telemetry rollups from the raw telemetry and exit')
+    args = parser.parse_args()
+    if args.rebuild_rollups:
+        if not os.path.exists(Telemetry.rawPath):
+            sys.exit("No raw telemetry in " + Telemetry.rawPath)
+        TelemetryRollup(Telemetry.tmPath).rebuild(Telemetry.rawPath)
+        print("Rebuilt the telemetry rollups in", Telemetry.tmPath)
+        sys.exit(0)
+    profile = StartupProfile(args.profile_startup)
 
-        try:
-            root.winfo_exists()
-        except:
-            running = False
-            app.ws.bk.saveAll()
+    root = tk.Tk()
+    app = Application(master=root, profile=profile)
+    root.protocol('WM_DELETE_WINDOW', app.onClose)
 
-        if(running):
-            app.onUpdate()
+    def editorReady():
+        # First idle moment of the event loop: the window has been drawn and takes input
+        root.update_idletasks()
+        profile.mark('editor ready')
+        profile.report()
+    root.after_idle(editorReady)
+    root.mainloop()
 
 
 
@@ -0,0 +1,788 @@
+# <GPLv3_Header>
+## - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# \copyright
+#                    Copyright (c) 2024 Nathan Ulmer.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+# <\GPLv3_Header>
+
+##
+# \file test_main.py
+#
+# \brief Headless tests of the Book, telemetry and markup code in main.py.
+# - - -
+# \par
+# Most tests apply random edits and compare the incremental result with a from-scratch recount. Needs no display.
+# \par
+# python -m unittest test_main   (or python -m pytest -q)
+
+import os
+import time
+import random
+import tempfile
+import unittest
+import contextlib
+import collections
+
+import main
+import benchmark
+
+
+EDITS = ('x', ' ', '\n', '#', '\n## New\n', 'sally ', 'walked down ', 'ab\ncd', '[', '|', ']', '<bold@', '>')
+
+
+def randomEdit(rng, text):
+    # (op, offset, text or length) of a random insert or delete against text
+    if rng.random() < 0.55 or len(text) < 5:
+        return ('insert', rng.randint(0, len(text)), rng.choice(EDITS))
+    return ('delete', rng.randrange(len(text)), rng.randint(1, 12))
+
+
+class BookCase(unittest.TestCase):
+    # Runs each test in its own temporary directory holding a generated book/ tree
+
+    words = 20000
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workDir = tempfile.TemporaryDirectory(prefix='writingapp-test-')
+        os.chdir(self.workDir.name)
+        benchmark.generateBook(main.Book.basePath, self.words)
+        self.bk = self.loadBook()
+
+    def tearDown(self):
+        self.bk.saver.stop()
+        os.chdir(self.cwd)
+        self.workDir.cleanup()
+
+    def loadBook(self):
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            return main.Book()
+
+    def editRandomly(self, rng, count, check=None, every=50):
+        docs = sorted(self.bk.docTree)
+        for i in range(count):
+            doc = rng.choice(docs)
+            (op, offset, arg) = randomEdit(rng, self.bk.getDocText(doc))
+            if op == 'insert':
+                self.bk.insertAt(doc, offset, arg)
+            else:
+                self.bk.deleteAt(doc, offset, arg)
+            if check is not None and i % every == 0:
+                check()
+
+    def freshIndex(self):
+        # A SearchIndex built from scratch over the Book as it is now
+        index = main.SearchIndex(self.bk)
+        for doc in self.bk.docTree:
+            index.setDoc(doc, len(self.bk.docTree[doc]))
+        index.refresh()
+        return index
+
+
+class TestDocSaver(BookCase):
+
+    words = 2000
+
+    def test_write_atomic(self):
+        path = self.bk.docPath('world')
+        os.chmod(path, 0o640)
+        self.bk.saver.writeAtomic(path, 'new text')
+        with open(path) as f:
+            self.assertEqual(f.read(), 'new text')
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+        fresh = os.path.join(main.Book.basePath, 'fresh')
+        self.bk.saver.writeAtomic(fresh, 'x')
+        self.assertEqual(os.stat(fresh).st_mode & 0o777, 0o666 & ~self.bk.saver.umask)
+        # A failed write leaves the old file and no temp file behind
+        with self.assertRaises(TypeError):
+            self.bk.saver.writeAtomic(path, None)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'new text')
+        self.assertEqual(sorted(os.listdir(main.Book.basePath)), sorted(list(self.bk.docTree) + ['fresh']))
+
+    def test_debounce_and_flush_on_stop(self):
+        saver = self.bk.saver
+        before = self.bk.getDocText('world')
+        self.bk.insertAt('world', 0, 'edited ')
+        self.assertTrue(saver.isDirty('world'))
+        saver.update()
+        # Still inside the debounce window, nothing is written yet
+        with open(self.bk.docPath('world')) as f:
+            self.assertEqual(f.read(), before)
+        saver.stop()
+        self.assertFalse(saver.isDirty())
+        with open(self.bk.docPath('world')) as f:
+            self.assertEqual(f.read(), 'edited ' + before)
+        self.bk.saver = main.DocSaver(self.bk)
+
+
+class TestTextBuffer(unittest.TestCase):
+
+    def test_random_edits(self):
+        rng = random.Random(0)
+        buf = main.TextBuffer()
+        buf.maxChunk = 16
+        buf.setText('one\ntwo\nthree')
+        ref = str(buf)
+        for _ in range(3000):
+            (op, offset, arg) = randomEdit(rng, ref)
+            if op == 'insert':
+                buf.insert(offset, arg)
+                ref = ref[:offset] + arg + ref[offset:]
+            else:
+                self.assertEqual(buf.delete(offset, arg), ref[offset:offset + arg])
+                ref = ref[:offset] + ref[offset + arg:]
+            self.assertEqual(len(buf), len(ref))
+            start = rng.randint(0, len(ref))
+            stop = rng.randint(start, len(ref))
+            self.assertEqual(buf.slice(start, stop), ref[start:stop])
+            self.assertEqual(buf.newlineCount(), ref.count('\n'))
+            self.assertEqual(buf.newlinesBefore(start), ref.count('\n', 0, start))
+            if ref.count('\n'):
+                k = rng.randint(1, ref.count('\n'))
+                self.assertEqual(buf.newlineAt(k), [i for (i, c) in enumerate(ref) if c == '\n'][k - 1])
+        self.assertEqual(str(buf), ref)
+
+
+class TestTokenizeMarkup(unittest.TestCase):
+
+    def test_round_trip(self):
+        rng = random.Random(9)
+        pieces = ('a', 'b c', '\n', '<', '>', '@', '<bold@', '<italic@ ', '< @', ']', '[book|', '|')
+        for _ in range(3000):
+            text = ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 12)))
+            for bookLinks in (False, True):
+                runs = list(main.tokenizeMarkup(text, bookLinks))
+                self.assertEqual(''.join(run for (run, tags) in runs), text)
+                self.assertTrue(all(run for (run, tags) in runs))
+                # What's left once the hidden delimiters are dropped is the text with the complete tags stripped
+                shown = main.TAG_PATTERN.sub(lambda m: m.group(2), text)
+                if bookLinks:
+                    shown = shown.replace(']', '')
+                self.assertEqual(''.join(run for (run, tags) in runs if 'hidden' not in tags), shown)
+
+    def test_tags(self):
+        runs = list(main.tokenizeMarkup('a <bold@ b] c> d]', True))
+        self.assertEqual(runs, [('a ', ()), ('<bold@', ('hidden',)), (' b', ('bold',)), (']', ('hidden',)),
+                                (' c', ('bold',)), ('>', ('hidden',)), (' d', ()), (']', ('hidden',))])
+
+
+class TestMarkupIndex(unittest.TestCase):
+
+    def check(self, mi, text):
+        matches = list(mi.pattern.finditer(text))
+        self.assertEqual(mi.positions(), [m.start() for m in matches])
+        self.assertEqual(mi.kinds, [m.group() for m in matches])
+        pieces = text.split(mi.closer)
+        for n in range(len(pieces) + 1):
+            r = mi.segmentRange(n, len(text))
+            if n == len(pieces):
+                self.assertIsNone(r)
+                continue
+            start = sum(len(p) + 1 for p in pieces[:n])
+            self.assertEqual(r, (start, start + len(pieces[n]), n < len(pieces) - 1))
+
+    def test_random_edits(self):
+        rng = random.Random(2)
+        for (opener, separator, closer) in (('[', '|', ']'), ('<', '@', '>')):
+            mi = main.MarkupIndex(opener, separator, closer)
+            text = 'a [b|c] d <e@f> g'
+            mi.rebuild(text)
+            for _ in range(2000):
+                (op, offset, arg) = randomEdit(rng, text)
+                if op == 'insert':
+                    mi.onInsert(offset, arg)
+                    text = text[:offset] + arg + text[offset:]
+                else:
+                    arg = text[offset:offset + arg]
+                    mi.onDelete(offset, arg)
+                    text = text[:offset] + text[offset + len(arg):]
+                self.check(mi, text)
+                pos = rng.randint(0, len(text))
+                self.assertEqual(mi.firstAtOrAfter(pos), sum(1 for p in mi.positions() if p < pos))
+
+
+class TestSectionIndex(unittest.TestCase):
+
+    def test_against_prefix_sums(self):
+        rng = random.Random(1)
+        counts = [[rng.randint(1, 50), rng.randint(0, 5)] for _ in range(200)]
+        idx = main.SectionIndex(counts)
+        for _ in range(2000):
+            s = rng.randrange(len(counts))
+            dChars = rng.randint(-counts[s][0] + 1, 20)
+            dLines = rng.randint(-counts[s][1], 3)
+            counts[s][0] += dChars
+            counts[s][1] += dLines
+            idx.add(s, dChars, dLines)
+            starts = [sum(c for (c, l) in counts[:i]) for i in range(len(counts) + 1)]
+            lines = [sum(l for (c, l) in counts[:i]) for i in range(len(counts) + 1)]
+            s = rng.randrange(len(counts))
+            self.assertEqual(idx.start(s), starts[s])
+            self.assertEqual(idx.linesBefore(s), lines[s])
+            offset = rng.randint(1, starts[-1])
+            self.assertEqual(idx.find(offset), max(i for i in range(len(counts)) if starts[i] < offset))
+            if lines[-1]:
+                line = rng.randint(1, lines[-1])
+                self.assertEqual(idx.findLine(line), min(i for i in range(len(counts)) if lines[i + 1] >= line))
+
+
+class TestBook(BookCase):
+
+    def test_counts_and_sections(self):
+        rng = random.Random(3)
+
+        def check():
+            self.assertEqual(self.bk.getTotalWords(), self.bk.getTotalWordsExpensive())
+            for doc in self.bk.docTree:
+                text = self.bk.getDocText(doc)
+                self.assertEqual([str(s) for s in self.bk.docTree[doc]], self.bk.splitSections(text))
+                offset = rng.randint(0, len(text))
+                (section, rel) = self.bk.locate(doc, offset)
+                self.assertEqual(self.bk.sectionStart(doc, section) + rel, offset)
+
+        self.editRandomly(rng, 1000, check)
+        check()
+
+
+class TestLoader(BookCase):
+
+    words = 5000
+
+    def test_background_load(self):
+        self.bk.saver.stop()
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            self.bk = main.Book(['book'])
+        self.assertEqual(sorted(self.bk.docTree), ['book'])
+        self.bk.loadInBackground()
+        for _ in range(500):
+            if self.bk.installLoaded():
+                break
+            time.sleep(0.01)
+        self.assertEqual(sorted(self.bk.docTree), self.bk.listDocs())
+        self.assertEqual(self.bk.getTotalWords(), self.bk.getTotalWordsExpensive())
+        for doc in self.bk.docTree:
+            with open(self.bk.docPath(doc)) as f:
+                self.assertEqual(self.bk.getDocText(doc), f.read())
+
+    def test_reload_only_changed_files(self):
+        parsed = []
+        self.bk.parseDoc = lambda docName, text: parsed.append(docName)
+        # Touched but unchanged, changed, new and removed files
+        os.utime(self.bk.docPath('world'))
+        with open(self.bk.docPath('characters'), 'a') as f:
+            f.write('more\n')
+        with open(self.bk.docPath('extra'), 'w') as f:
+            f.write('new\n')
+        os.remove(self.bk.docPath('partOutline'))
+        self.bk.loadDocTree()
+        self.assertEqual(sorted(parsed), ['characters', 'extra'])
+        self.assertNotIn('partOutline', self.bk.docTree)
+
+    def test_directory_case(self):
+        self.bk.saver.stop()
+        os.rename(main.Book.basePath, main.Book.basePath.capitalize())
+        self.bk = self.loadBook()
+        self.assertEqual(self.bk.basePath, main.Book.basePath.capitalize())
+        self.assertEqual(sorted(self.bk.docTree), sorted(os.listdir(self.bk.basePath)))
+
+
+class TestDocWatcher(BookCase):
+
+    words = 2000
+
+    def scan(self, watcher):
+        # The watcher thread must only read the Book
+        stamps = dict(self.bk.fileStamps)
+        watcher.scan()
+        self.assertEqual(self.bk.fileStamps, stamps)
+        return watcher.changes()
+
+    def test_reports(self):
+        watcher = main.DocWatcher(self.bk)
+        self.assertEqual(self.scan(watcher), [])
+        # Our own saves, before and after the UI thread has collected their stamps
+        self.bk.insertAt('world', 0, 'saved ')
+        self.bk.saver.submit()
+        self.bk.saver.jobs.join()
+        self.assertEqual(self.scan(watcher), [])
+        self.bk.saver.flush()
+        self.assertEqual(self.scan(watcher), [])
+        # Touched without changing
+        os.utime(self.bk.docPath('characters'), ns=(1, 1))
+        self.assertEqual(self.scan(watcher), [])
+        # Changed by someone else, reported once
+        with open(self.bk.docPath('characters'), 'a') as f:
+            f.write('outside\n')
+        found = self.scan(watcher)
+        self.assertEqual([(d, t) for (d, t, s) in found], [('characters', self.bk.readDoc('characters')[0])])
+        self.assertEqual(self.scan(watcher), [])
+        # New and removed files
+        with open(self.bk.docPath('extra'), 'w') as f:
+            f.write('new\n')
+        os.remove(self.bk.docPath('partOutline'))
+        found = self.scan(watcher)
+        self.assertEqual(sorted((d, t) for (d, t, s) in found), [('extra', 'new\n'), ('partOutline', None)])
+        self.assertEqual(self.scan(watcher), [])
+
+    def test_keep_disk_copy(self):
+        path = self.bk.keepDiskCopy('world', 'from disk')
+        self.assertTrue(os.path.basename(path).startswith('world.disk-'))
+        with open(path) as f:
+            self.assertEqual(f.read(), 'from disk')
+        self.assertNotEqual(self.bk.keepDiskCopy('world', 'again'), path)
+        self.assertIn(os.path.basename(path), self.bk.listDocs())
+
+
+class TestTelemetrySink(unittest.TestCase):
+
+    def test_batches_in_order(self):
+        with tempfile.TemporaryDirectory(prefix='sink') as path:
+            rawPath = os.path.join(path, 'raw.csv')
+            sink = main.TelemetrySink(rawPath)
+            records = ['%d,%d,%d;' % (i, i, i) for i in range(main.TelemetrySink.maxBuffered)]
+            for record in records:
+                sink.write(record)
+            # A full buffer wakes the writer without waiting for flushInterval
+            for _ in range(100):
+                if os.path.exists(rawPath):
+                    break
+                time.sleep(0.01)
+            self.assertTrue(os.path.exists(rawPath))
+            sink.write('last;')
+            sink.close()
+            sink.close()
+            with open(rawPath) as f:
+                self.assertEqual(f.read(), ''.join(records) + 'last;')
+
+    def test_keeps_records_it_could_not_write(self):
+        with tempfile.TemporaryDirectory(prefix='sink') as path:
+            sink = main.TelemetrySink(os.path.join(path, 'missing', 'raw.csv'))
+            sink.write('a;')
+            with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                sink.close()
+            self.assertEqual(sink.buffer, ['a;'])
+
+
+class TestTelemetryStore(unittest.TestCase):
+
+    class SmallStore(main.TelemetryStore):
+        liveCapacity = 8
+
+    def test_spill_and_read_back(self):
+        np = main.loadNumpy()
+        with tempfile.TemporaryDirectory(prefix='telem') as path:
+            store = self.SmallStore(path, 'test')
+            samples = [(i * 0.5, i * 3, i // 2) for i in range(101)]
+            for (k, sample) in enumerate(samples):
+                store.append(*sample)
+                self.assertEqual(len(store), k + 1)
+                self.assertLessEqual(store.end, 2 * store.liveCapacity)
+            self.assertEqual(store.spilled % store.liveCapacity, 0)
+            self.assertGreater(store.spilled, 0)
+            for (c, (col, dtype)) in enumerate(store.columns):
+                expected = np.array([s[c] for s in samples], dtype=dtype)
+                self.assertEqual(os.path.getsize(store.segmentPath(col)), store.spilled * expected.itemsize)
+                self.assertTrue((store.read(col, 0, len(store)) == expected).all())
+                # Ranges inside the history, straddling it and inside the live window
+                for (start, stop) in ((3, 20), (store.spilled - 5, store.spilled + 5), (store.spilled + 1, 101)):
+                    self.assertTrue((store.read(col, start, stop) == expected[start:stop]).all(), (col, start))
+                self.assertTrue((store.live(col) == expected[store.spilled:]).all())
+
+
+class TestSyncEngine(BookCase):
+
+    words = 0
+
+    def writeDocs(self, notes, book):
+        with open(self.bk.docPath('unstructured'), 'w') as f:
+            f.write(notes)
+        with open(self.bk.docPath('book'), 'w') as f:
+            f.write(book)
+        self.bk.saver.stop()
+        self.bk = self.loadBook()
+        self.sync = main.SyncEngine(self.bk)
+
+    def edit(self, doc, op, offset, text):
+        # Apply an edit the way the panes do and return the mirrored edits, which are applied too
+        if op == 'insert':
+            self.bk.insertAt(doc, offset, text)
+        else:
+            text = self.bk.deleteAt(doc, offset, text)
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            edits = self.sync.propagate(doc, op, offset, text)
+        for (other, start, end, replacement) in edits:
+            self.bk.deleteAt(other, start, end - start)
+            self.bk.insertAt(other, start, replacement)
+        return edits
+
+    def test_segments_after_a_newline(self):
+        self.writeDocs('a [book|first] b [book|dog ran] c\n', 'first]\ndog ran]\ntail')
+        # In the book: the segment starts with the '\n' after the previous ']'
+        book = self.bk.getDocText('book')
+        self.assertEqual(len(self.edit('book', 'insert', book.index('dog') + 3, 'Q')), 1)
+        self.assertIn('[book|dogQ ran]', self.bk.getDocText('unstructured'))
+        # In the notes
+        notes = self.bk.getDocText('unstructured')
+        self.assertEqual(len(self.edit('unstructured', 'delete', notes.index(' ran'), 1)), 1)
+        self.assertEqual(self.bk.getDocText('book'), 'first]\ndogQran]\ntail')
+        self.assertIn('[book|dogQran]', self.bk.getDocText('unstructured'))
+        # Typing straight after a ']' is between two segments, no passage gets it
+        self.assertEqual(self.edit('book', 'insert', len('first]'), 'Z'), [])
+        self.assertEqual(self.bk.getDocText('unstructured'), 'a [book|first] b [book|dogQran] c\n')
+
+    def test_leading_newlines_round_trip(self):
+        self.writeDocs('[book|first]\n[book|dog]\n', 'first]\ndog]\n')
+        # Newlines typed at the start of the text and into the leading newlines, then deleted again
+        typed = []
+        for (doc, rel) in (('book', 0), ('book', -1), ('unstructured', 0), ('book', -2)):
+            offset = self.bk.getDocText(doc).index('dog]') + rel
+            self.edit(doc, 'insert', offset, '\n')
+            typed.append((doc, offset))
+        for (doc, offset) in reversed(typed):
+            self.edit(doc, 'delete', offset, 1)
+        self.assertEqual(self.bk.getDocText('book'), 'first]\ndog]\n')
+        self.assertEqual(self.bk.getDocText('unstructured'), '[book|first]\n[book|dog]\n')
+        self.assertEqual(self.sync.mismatched, set())
+
+    def test_differing_pair_is_left_alone(self):
+        # Passages and segments out of order, like the shipped Book/: neither side may overwrite the other
+        self.writeDocs('[book|yo]\n[book|Prologue]\n', 'Prologue]\nyo]\n')
+        self.assertEqual(self.edit('unstructured', 'insert', 7, 'X'), [])
+        self.assertEqual(self.edit('book', 'insert', 3, 'Y'), [])
+        self.assertEqual(self.bk.getDocText('book'), 'ProYlogue]\nyo]\n')
+        self.assertEqual(self.bk.getDocText('unstructured'), '[book|yXo]\n[book|Prologue]\n')
+        self.assertEqual(self.sync.mismatched, {('unstructured', 'book', 0)})
+        # Closing the link again copies it over and syncing resumes
+        for (other, start, end, text) in self.sync.linkClosed('unstructured', 0):
+            self.bk.deleteAt(other, start, end - start)
+            self.bk.insertAt(other, start, text)
+        self.assertEqual(self.bk.getDocText('book'), 'yXo]\nyo]\n')
+        self.assertEqual(len(self.edit('book', 'insert', 0, 'W')), 1)
+        self.assertEqual(self.bk.getDocText('unstructured'), '[book|WyXo]\n[book|Prologue]\n')
+        self.assertEqual(self.sync.mismatched, set())
+
+
+class TestWpmSeries(unittest.TestCase):
+
+    def series(self, samples, capacity=main.TelemetryStore.liveCapacity):
+        with tempfile.TemporaryDirectory(prefix='telem') as path:
+            store = main.TelemetryStore(path, 'test')
+            wpm = main.WpmSeries(capacity)
+            for (k, sample) in enumerate(samples):
+                store.append(*sample)
+                if k % 97 == 0:
+                    wpm.extend(store)
+            wpm.extend(store)
+            return wpm
+
+    def test_pause_counts_by_its_length(self):
+        # 100 chars at 0.1 s gaps, then a 60 s pause before the next keystroke
+        samples = [(i * 0.1, i, 0) for i in range(101)] + [(70.0, 101, 0)]
+        wpm = self.series(samples)
+        (times, rate) = wpm.smoothed()
+        # The last window is samples 50..101: 51 chars in 65 s, not the 120 WPM of the burst it mostly holds
+        self.assertAlmostEqual(rate[-1], 51 * 60 / 5 / 65.0)
+        self.assertAlmostEqual(times[-1], 70.0)
+        self.assertAlmostEqual(wpm.mean(), 101 * 60 / 5 / 70.0)
+
+    def test_uneven_gaps_against_direct_rates(self):
+        np = main.loadNumpy()
+        rng = random.Random(5)
+        (t, chars) = (0.0, 0)
+        samples = []
+        for _ in range(3000):
+            t += rng.choice((0.05, 0.1, 0.3, 2.0, 45.0))
+            chars += rng.randint(-1, 4)
+            samples.append((t, chars, chars // 5))
+        for capacity in (main.TelemetryStore.liveCapacity, 600):
+            wpm = self.series(samples, capacity)
+            kept = samples[-wpm.count:]
+            w = min(wpm.N, len(kept) // 2)
+            rates = {kept[j + w][0]: (kept[j + w][1] - kept[j][1]) * 60 / 5 / (kept[j + w][0] - kept[j][0])
+                     for j in range(len(kept) - w)}
+            (times, rate) = wpm.smoothed()
+            self.assertLessEqual(len(times), wpm.maxPoints)
+            self.assertEqual(times[-1], samples[-1][0])
+            self.assertTrue(np.allclose(rate, [rates[x] for x in times]))
+            self.assertAlmostEqual(wpm.mean(), (samples[-1][1] - samples[0][1]) * 60 / 5 / (t - samples[0][0]))
+
+
+class FakeRoot:
+    # Stands in for the Tk root: remembers the pending after() callback instead of running an event loop
+
+    def __init__(self):
+        self.pending = {}
+        self.nextId = 0
+
+    def after(self, ms, fn):
+        self.nextId += 1
+        self.pending[self.nextId] = (ms, fn)
+        return self.nextId
+
+    def after_cancel(self, afterId):
+        self.pending.pop(afterId, None)
+
+
+class TestScheduler(BookCase):
+
+    words = 0
+
+    def test_session_jobs_back_off_when_idle(self):
+        scheduler = main.Scheduler(FakeRoot())
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            session = main.WritingSession()
+        try:
+            session.schedule(scheduler)
+            scheduler.addJob('plain', lambda: None, 0.5)
+            self.assertEqual(len(scheduler.jobs), 6)
+            for job in scheduler.jobs:
+                self.assertGreater(job.idleInterval, job.interval, job.name)
+        finally:
+            session.close()
+
+    def test_idle_and_done_intervals(self):
+        root = FakeRoot()
+        scheduler = main.Scheduler(root)
+        runs = []
+        busy = scheduler.addJob('busy', lambda: runs.append('busy'), 0.1, idleInterval=3.0)
+        done = scheduler.addJob('done', lambda: runs.append('done') or True, 0.1, idleInterval=4.0)
+        scheduler.start()
+        self.assertEqual(len(root.pending), 1)
+
+        def tick():
+            for job in scheduler.jobs:
+                job.due = 0
+            now = time.time()
+            # Fire the pending after() callback the way Tk would
+            (afterId, (ms, fn)) = root.pending.popitem()
+            fn()
+            return now
+
+        # Active: the busy job keeps its interval, the one that reported nothing left to do backs off
+        scheduler.poke()
+        now = tick()
+        self.assertEqual(sorted(runs), ['busy', 'done'])
+        self.assertAlmostEqual(busy.due - now, 0.1, delta=0.05)
+        self.assertAlmostEqual(done.due - now, 4.0, delta=0.05)
+        (ms, fn) = list(root.pending.values())[0]
+        self.assertAlmostEqual(ms, 100, delta=50)
+
+        # Idle: everything backs off, and input brings the next run back in
+        scheduler.lastActivity -= scheduler.idleAfter
+        now = tick()
+        self.assertAlmostEqual(busy.due - now, 3.0, delta=0.05)
+        self.assertAlmostEqual(done.due - now, 4.0, delta=0.05)
+        scheduler.poke()
+        self.assertAlmostEqual(busy.due - now, 0.1, delta=0.05)
+        self.assertEqual(len(root.pending), 1)
+        scheduler.stop()
+        self.assertEqual(root.pending, {})
+
+
+class TestSearchIndex(BookCase):
+
+    def test_against_fresh_index(self):
+        rng = random.Random(4)
+        queries = ('sally', 'the', 'walked down', 'the dog walked', 'chapter', 'bold', 'zzz')
+
+        def check():
+            fresh = self.freshIndex()
+            for query in queries:
+                self.assertEqual(self.bk.search.search(query), fresh.search(query), query)
+
+        self.bk.search.refresh()
+        self.editRandomly(rng, 600, check, every=100)
+        check()
+
+    def test_cache_round_trip(self):
+        self.bk.search.refresh()
+        expected = self.bk.search.search('walked down')
+        self.bk.search.save()
+        self.bk.saver.stop()
+        self.bk = self.loadBook()
+        self.bk.search.refresh()
+        self.assertEqual(self.bk.search.search('walked down'), expected)
+
+
+class TestTermMatcher(unittest.TestCase):
+
+    def oracle(self, terms, text):
+        found = []
+        for term in set(terms):
+            start = text.find(term)
+            while start >= 0:
+                end = start + len(term)
+                if not (start > 0 and (text[start - 1].isalnum() or text[start - 1] == '_')) and \
+                        not (end < len(text) and (text[end].isalnum() or text[end] == '_')):
+                    found.append((start, end))
+                start = text.find(term, start + 1)
+        found.sort(key=lambda span: (span[0], -span[1]))
+        spans = []
+        for span in found:
+            if not spans or span[0] >= spans[-1][1]:
+                spans.append(span)
+        return spans
+
+    def test_overlaps_and_word_boundaries(self):
+        matcher = main.TermMatcher(['Sally', 'Sally Smith', 'Smith', 'Smithy'])
+        text = 'Sally Smith met Smithy, not Sallyx or x_Sally. Sally Smithson and Sally.'
+        self.assertEqual([text[s:e] for (s, e) in matcher.find(text)],
+                         ['Sally Smith', 'Smithy', 'Sally', 'Sally'])
+
+    def test_random_against_oracle(self):
+        rng = random.Random(22)
+        for _ in range(300):
+            terms = [''.join(rng.choice('ab ') for _ in range(rng.randint(1, 4))).strip() for _ in range(6)]
+            terms = [t for t in terms if t]
+            text = ''.join(rng.choice('ab _.') for _ in range(rng.randint(0, 40)))
+            self.assertEqual(main.TermMatcher(terms).find(text), self.oracle(terms, text), (terms, text))
+
+
+class TestWordStats(BookCase):
+
+    def test_against_fresh_index(self):
+        rng = random.Random(4)
+
+        def check():
+            (stats, expected) = (self.bk.search.updateStats(), self.freshIndex().updateStats())
+            self.assertEqual(stats.totals, expected.totals)
+            self.assertEqual(stats.buckets, expected.buckets)
+            self.assertEqual(stats.bucketWords, expected.bucketWords)
+
+        self.bk.search.refresh()
+        self.editRandomly(rng, 600, check, every=100)
+        check()
+
+
+class TestReadability(BookCase):
+
+    words = 5000
+
+    def waitFor(self, tracker, timeout=60):
+        deadline = time.time() + timeout
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            tracker.update()
+            while tracker.running and time.time() < deadline:
+                time.sleep(0.05)
+                tracker.update()
+        self.assertFalse(tracker.running)
+
+    def expected(self, tracker):
+        counts = [main.readabilityCounts(str(s)) for s in self.bk.docTree[tracker.metricsDoc]]
+        totals = [sum(c[i] for c in counts) for i in range(4)]
+        return ([tracker.scores(c) for c in counts], tracker.scores(totals))
+
+    def test_counts(self):
+        # The heading line and the markup are left out; 'because' makes the second sentence complex
+        text = '## Chapter One\nThe cat sat on the mat. Because it rained, we stayed in!\n<bold@Rain> fell [Sally|Sal] today'
+        self.assertEqual(main.readabilityCounts(text), (3, 16, 19, 1))
+        self.assertEqual(main.readabilityCounts('## Chapter One\n'), (0, 0, 0, 0))
+        self.assertEqual([main.syllableCount(w) for w in ('cat', 'table', 'agree', 'make', 'reading')], [1, 2, 2, 1, 2])
+
+    def test_series_after_edits(self):
+        rng = random.Random(24)
+        tracker = main.ReadabilityTracker(self.bk)
+        try:
+            for _ in range(3):
+                self.editRandomly(rng, 100)
+                self.waitFor(tracker)
+                self.assertEqual((tracker.series(), tracker.overall()), self.expected(tracker))
+        finally:
+            tracker.close()
+
+    def test_broken_pool_falls_back_to_threads(self):
+        import concurrent.futures
+        tracker = main.ReadabilityTracker(self.bk)
+        try:
+            self.waitFor(tracker)
+            # Kill the workers, then change every section so all of them have to be counted again
+            for process in list(tracker.pool._processes.values()):
+                process.kill()
+            doc = tracker.metricsDoc
+            for section in reversed(range(len(self.bk.docTree[doc]))):
+                self.bk.insertAt(doc, self.bk.sectionStart(doc, section) + 1, 'Extra words here. ')
+            self.waitFor(tracker)
+            self.assertIsInstance(tracker.pool, concurrent.futures.ThreadPoolExecutor)
+            self.assertEqual((tracker.series(), tracker.overall()), self.expected(tracker))
+        finally:
+            tracker.close()
+
+
+class TestTelemetryRollup(unittest.TestCase):
+
+    def test_against_direct_aggregation(self):
+        rng = random.Random(6)
+        t = time.mktime((2026, 1, 1, 9, 0, 0, 0, 0, -1))
+        chars = 0
+        sessions = []
+        for _ in range(15):
+            t += rng.uniform(3600, 3 * 86400)
+            samples = []
+            for _ in range(rng.randint(20, 300)):
+                t += rng.choice((0.2, 0.5, 1, 2, 40))
+                chars += rng.randint(-1, 5)
+                samples.append((t, chars, chars // 5))
+            sessions.append(samples)
+
+        with tempfile.TemporaryDirectory(prefix='rollup') as path:
+            # A new rollup per session, like a restart of the app between sessions. Flushed by a sink's writer
+            # thread, the way Telemetry does it, and often enough to overlap the adds.
+            for samples in sessions:
+                rollup = main.TelemetryRollup(os.path.join(path, 'live'))
+                sink = main.TelemetrySink(os.path.join(path, 'sink.csv'))
+                sink.flushInterval = 0.001
+                rollup.startSession()
+                for sample in samples:
+                    if rollup.add(*sample) or rng.random() < 0.1:
+                        sink.call(rollup.flush)
+                sink.call(rollup.flush)
+                sink.close()
+            live = main.TelemetryRollup(os.path.join(path, 'live'))
+
+            csvPath = os.path.join(path, 'raw.csv')
+            with open(csvPath, 'w') as f:
+                f.write('\n' + '\n'.join(''.join('%r,%d,%d;' % s for s in samples) for samples in sessions))
+            rebuilt = main.TelemetryRollup(os.path.join(path, 'rebuilt'))
+            rebuilt.rebuild(csvPath)
+
+            for (level, width) in main.TelemetryRollup.levels:
+                rows = collections.OrderedDict()
+                for samples in sessions:
+                    prev = None
+                    for (st, sc, sw) in samples:
+                        bucket = live.bucketOf(st, width)
+                        row = rows.setdefault(bucket, [bucket, 0, 0, 0.0, 0])
+                        if prev is None:
+                            row[4] += 1
+                        else:
+                            gap = st - prev[0]
+                            row[1] += sw - prev[2]
+                            row[2] += max(sc - prev[1], 0)
+                            row[3] += gap if 0 < gap <= main.TelemetryRollup.idleGap else 0
+                        prev = (st, sc, sw)
+                for got in (live.read(level), rebuilt.read(level)):
+                    self.assertEqual(len(got), len(rows), level)
+                    for (expected, row) in zip(rows.values(), got):
+                        self.assertEqual([row[f].item() for f in ('bucket', 'words', 'chars', 'sessions')],
+                                         [expected[0], expected[1], expected[2], expected[4]])
+                        self.assertAlmostEqual(row['active'].item(), expected[3])
+
+
+
+if __name__ == '__main__':
+    unittest.main()